@@ -1,6 +1,8 @@
 # app.py: 哈耶克研究委员会 Streamlit 网页应用（优化阅读器交互）
 import streamlit as st
-from query_handler import handle_query
+from service_client import SERVICE_URL, ServiceClient
+from tracing import recent_traces, stage_durations
+import numpy as np
 from dotenv import load_dotenv
 import os
 import re
@@ -8,9 +10,27 @@ import re
 # 加载 .env
 load_dotenv()
 
+# 性能面板展示的查询阶段（与 query_handler.handle_query_stream 中的 span 名一致）
+QUERY_STAGES = ('get_index', 'refine_query', 'embed_query', 'faiss_search', 'fetch_chunks', 'generate_report', 'llm')
+
 # 页面配置
 st.set_page_config(page_title="哈耶克研究委员会", page_icon="📚", layout="wide")
 
+if SERVICE_URL:
+    # 瘦客户端：索引、模型与 HTTP 客户端都在 retrieval_service.py 中，本进程不加载索引
+    client = ServiceClient(SERVICE_URL)
+    handle_query_stream = client.handle_query_stream
+    list_sources = client.list_sources
+else:
+    from query_handler import handle_query_stream
+    from index_cache import get_index
+    # 索引在进程内只加载一次，所有会话共享（磁盘上的索引更新后自动热切换）
+    with st.spinner("正在加载索引..."):
+        get_index()
+
+    def list_sources():
+        return get_index().index.sources
+
 # 会话状态：保存历史记录
 if "history" not in st.session_state:
     st.session_state.history = []
@@ -19,6 +39,13 @@ if "history" not in st.session_state:
 with st.sidebar:
     st.title("设置")
     st.markdown("欢迎！输入中文问题，获取 Hayek 观点分析。")
+    # 限定书目：只搜索所选书的索引分片，不选则检索全部
+    try:
+        source_options = list_sources()
+    except Exception as e:
+        source_options = []
+        st.warning(f"无法获取书目列表：{e}")
+    books = st.multiselect("限定书目（可选）", source_options, help="只在所选书中检索；不选则检索全部书目。")
     if st.button("清空历史"):
         st.session_state.history = []
         st.rerun()
@@ -30,17 +57,35 @@ st.markdown("请输入您的中文问题（例如：'哈耶克如何看待中央
 question = st.text_input("您的提问：", key="input")
 
 if st.button("提交") and question:
-    with st.spinner("委员会正在分析中...（这可能需要几秒钟）"):
-        try:
-            report, retrieved_chunks, keywords = handle_query(question)
-            st.session_state.history.append({"question": question, "report": report, "chunks": retrieved_chunks, "keywords": keywords})
-        except Exception as e:
-            st.error(f"处理出错：{e}。请检查 Ollama 是否运行或 API key 是否有效。")
+    # 流式渲染：先显示精炼结果与召回来源，再逐段显示报告
+    status_box = st.empty()
+    report_box = st.empty()
+    status_box.info("委员会正在分析中...（精炼问题）")
+    report_text = ""
+    try:
+        for event, payload in handle_query_stream(question, sources=books or None):
+            if event == "refine":
+                keywords_str = ', '.join(payload["keywords"]) or "无"
+                status_box.info(f"提取关键词：{keywords_str}　正在检索来源...")
+            elif event == "sources":
+                status_box.info(f"已召回 {len(payload)} 个来源 chunks，正在生成报告...")
+            elif event == "token":
+                report_text += payload
+                report_box.markdown(report_text + "▌")
+            elif event == "done":
+                st.session_state.history.append({"question": question, "report": payload["report"], "chunks": payload["chunks"], "keywords": payload["keywords"], "books": books})
+    except Exception as e:
+        st.error(f"处理出错：{e}。请检查 Ollama 是否运行或 API key 是否有效。")
+    # 完整结果已进入历史记录，由下方统一渲染
+    status_box.empty()
+    report_box.empty()
 
 # 显示历史报告，并在每个报告底部加 chunks 阅读器（用 tabs 作为标签页）
 for entry in st.session_state.history:
     with st.chat_message("user"):
         st.markdown(f"**提问：** {entry['question']}")
+        if entry.get("books"):
+            st.caption(f"限定书目：{'、'.join(entry['books'])}")
     with st.chat_message("assistant"):
         # 在报告中展示关键词
         if entry.get("keywords"):
@@ -87,7 +132,15 @@ for entry in st.session_state.history:
         for i, tab in enumerate(tabs):
             with tab:
                 chunk = chunks[i]
-                st.markdown(f"**来源：** {chunk['metadata']['source_file']} | **ID：** {chunk['metadata']['chunk_id']} | **页码估算：** {chunk['metadata']['page_estimate']}")
+                meta = chunk['metadata']
+                if 'page' in meta:
+                    pages = str(meta['page']) if meta['page'] == meta['page_end'] else f"{meta['page']}-{meta['page_end']}"
+                    # EPUB 的 page 是章节（XHTML 文档）序号，不是页码
+                    unit = '章节' if meta['source_file'].lower().endswith('.epub') else '页码'
+                    page_label = f"**{unit}：** {pages}"
+                else:  # 旧索引只有按父块序号估算的页码
+                    page_label = f"**页码估算：** {meta['page_estimate']}"
+                st.markdown(f"**来源：** {meta['source_file']} | **ID：** {meta['chunk_id']} | {page_label}")
                 
                 # 高亮关键词
                 chunk_text = chunk['text']
@@ -101,4 +154,29 @@ for entry in st.session_state.history:
     st.markdown("---")  # 分隔历史 entry
 
 # 底部提示
-st.caption("This is AI-generated inspiration based on Hayek's works, not authoritative interpretation.")
\ No newline at end of file
+st.caption("This is AI-generated inspiration based on Hayek's works, not authoritative interpretation.")
+
+# 侧边栏性能面板：放在页面末尾渲染，包含本次提交的查询（数据来自 tracing.py 的进程内记录）
+with st.sidebar:
+    with st.expander("性能（最近查询）"):
+        traces = recent_traces('query', limit=10)
+        if not traces:
+            st.caption("暂无查询记录。" + ("（查询在检索服务中执行，计时见服务端的 hayek_trace.jsonl）" if SERVICE_URL else ""))
+        else:
+            rows = []
+            for trace in reversed(traces):  # 最新的在前
+                root = trace['root']
+                row = {'问题': root['attrs'].get('question', '')[:20], '总计 ms': round(root['duration_ms'])}
+                for stage in QUERY_STAGES:
+                    row[stage] = round(trace['stages'].get(stage, 0))
+                rows.append(row)
+            st.dataframe(rows)
+
+            durations = stage_durations()
+            stage = st.selectbox("阶段耗时分布", [name for name in ('query',) + QUERY_STAGES if name in durations])
+            if stage:
+                samples = durations[stage]
+                counts, edges = np.histogram(samples, bins=min(20, max(1, len(samples))))
+                st.bar_chart({'ms': [round(e) for e in edges[:-1]], '次数': counts.tolist()}, x='ms', y='次数')
+                p50, p95 = np.percentile(samples, [50, 95])
+                st.caption(f"{len(samples)} 次，p50 {p50:.0f} ms，p95 {p95:.0f} ms")
\ No newline at end of file
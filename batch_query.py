@@ -0,0 +1,162 @@
+# batch_query.py: 批量生成报告（从文件读取问题并去重；并发精炼与生成，批量 embedding + 一次多向量检索；结果流式写入 JSONL，可断点续跑）
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+from cache import get_cache, normalize_question
+from index_cache import get_index
+from query_handler import (refine_query, retrieve_chunks_batch, generate_report, answer_cache_key,
+                           unsuitable_report, analysis_prefix)
+from tracing import span
+
+# 常量
+BATCH_WORKERS = 8  # 并发精炼/生成的线程数（实际在途的 DeepSeek 请求另受 DEEPSEEK_MAX_CONCURRENCY 限制）
+
+# Function to read questions from a file
+# .jsonl 文件每行一个 {"question": ...}；其他文件每行一个问题，空行与 # 开头的行忽略
+# 按规范化后的问题去重，保留首次出现的顺序
+def read_questions(path: str) -> List[str]:
+    questions = []
+    seen = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            question = json.loads(line)['question'] if path.lower().endswith('.jsonl') else line
+            key = normalize_question(question)
+            if key and key not in seen:
+                seen.add(key)
+                questions.append(question)
+    return questions
+
+# 输出文件中已成功完成的问题（规范化后）；中断时写了一半的行直接忽略
+def load_completed(output_path: str) -> set:
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') == 'ok':
+                done.add(normalize_question(record['question']))
+    return done
+
+def _source(chunk: dict) -> dict:
+    meta = chunk['metadata']
+    return {k: meta[k] for k in ('source_file', 'chunk_id', 'page', 'page_end', 'page_estimate') if k in meta}
+
+def _record(question: str, report: str, chunks: List[dict], keywords: List[str], english_query: str = '') -> dict:
+    return {
+        'question': question,
+        'status': 'ok',
+        'english_query': english_query,
+        'keywords': keywords,
+        'report': report,
+        'sources': [_source(c) for c in chunks],
+    }
+
+def _error_record(question: str, stage: str, error: Exception) -> dict:
+    return {'question': question, 'status': 'error', 'stage': stage, 'error': str(error)}
+
+# Function to run a batch of questions
+# 返回统计 {'questions', 'skipped', 'ok', 'failed'}；失败的问题不算完成，重新运行时会再次处理
+def run_batch(input_path: str, output_path: str, workers: int = BATCH_WORKERS) -> dict:
+    questions = read_questions(input_path)
+    done = load_completed(output_path)
+    pending = [q for q in questions if normalize_question(q) not in done]
+    stats = {'questions': len(questions), 'skipped': len(questions) - len(pending), 'ok': 0, 'failed': 0}
+    print(f"{len(questions)} unique questions, {stats['skipped']} already done, {len(pending)} to process.")
+    if not pending:
+        return stats
+
+    index, parents, subs, index_version = get_index()  # 整个批次使用同一个索引快照
+    lock = threading.Lock()
+
+    # 上次中断时最后一行可能没写完，先补一个换行，避免与新记录拼在同一行
+    needs_newline = False
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+
+    with open(output_path, 'a', encoding='utf-8') as out, span('batch_query', questions=len(pending), workers=workers) as root:
+        if needs_newline:
+            out.write('\n')
+
+        # 每完成一条立即写出并 flush，中断后已写出的结果不会丢失
+        def write(record: dict) -> None:
+            with lock:
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                out.flush()
+                stats['ok' if record['status'] == 'ok' else 'failed'] += 1
+
+        def finish(question: str, report: str, chunks: List[dict], keywords: List[str], english_query: str) -> None:
+            get_cache().set('answer', answer_cache_key(question, index_version), [report, chunks, keywords])
+            write(_record(question, report, chunks, keywords, english_query))
+
+        # 1. 整份结果已缓存（例如之前在 UI 中问过）的问题直接写出
+        todo = []
+        for question in pending:
+            cached = get_cache().get('answer', answer_cache_key(question, index_version))
+            if cached is not None:
+                report, chunks, keywords = cached
+                write(_record(question, report, chunks, keywords))
+            else:
+                todo.append(question)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # 2. 并发精炼
+            refined = {}
+            with span('batch_refine', questions=len(todo)):
+                futures = {executor.submit(refine_query, q): q for q in todo}
+                for fut in as_completed(futures):
+                    question = futures[fut]
+                    try:
+                        refined[question] = fut.result()
+                    except Exception as e:
+                        write(_error_record(question, 'refine', e))
+
+            # 3. 不适合的问题直接给出建议报告；其余一次批量 embedding + 一次多向量 FAISS 搜索
+            suitable = []
+            for question in todo:
+                if question not in refined:
+                    continue
+                english_query, keywords, analysis = refined[question]
+                if english_query:
+                    suitable.append(question)
+                else:
+                    finish(question, unsuitable_report(question, analysis), [], keywords, english_query)
+            retrieved = retrieve_chunks_batch([refined[q][0] for q in suitable], index, parents, subs)
+
+            # 4. 并发生成报告，完成一条写出一条
+            with span('batch_generate', questions=len(suitable)):
+                futures = {executor.submit(generate_report, q, chunks, refined[q][2]): (q, chunks)
+                           for q, chunks in zip(suitable, retrieved)}
+                for fut in as_completed(futures):
+                    question, chunks = futures[fut]
+                    english_query, keywords, analysis = refined[question]
+                    try:
+                        report = analysis_prefix(analysis) + fut.result()
+                    except Exception as e:
+                        write(_error_record(question, 'generate', e))
+                        continue
+                    finish(question, report, chunks, keywords, english_query)
+        root.set(ok=stats['ok'], failed=stats['failed'])
+
+    print(f"Batch finished: {stats['ok']} ok, {stats['failed']} failed, {stats['skipped']} skipped. Results in {output_path}")
+    return stats
+
+# 命令行：python batch_query.py questions.txt -o reports.jsonl [--workers 8]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate reports for a file of questions.")
+    parser.add_argument('input', help="questions file (.txt: one per line, .jsonl: {\"question\": ...} per line)")
+    parser.add_argument('-o', '--output', default='batch_reports.jsonl', help="JSONL output (appended to; finished questions are skipped)")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    args = parser.parse_args()
+    run_batch(args.input, args.output, args.workers)
@@ -0,0 +1,362 @@
+# benchmark.py: 离线基准测试（本地 stub 代替 Ollama 与 DeepSeek），测量索引构建吞吐、加载耗时、查询延迟与峰值内存
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+import numpy as np
+from ebooklib import epub
+
+# 常量
+BENCH_SIZES = (2, 8, 32)          # 合成语料的书本数（逐级增大）
+BENCH_CHAPTERS = 20               # 每本书的章节数
+BENCH_PARAGRAPHS = 15             # 每章的段落数
+BENCH_QUERIES = 50                # 每个规模测量的查询数
+BENCH_RESULTS_DIR = 'bench_results'
+STUB_EMBED_DIM = 768              # stub embedding 维度（与 embeddinggemma 一致）
+STUB_EMBED_LATENCY = 0.02         # 每个 embedding 请求的固定延迟（秒）
+STUB_EMBED_ITEM_LATENCY = 0.0     # embedding 请求中每条文本的额外延迟（秒）
+STUB_LLM_LATENCY = 0.2            # DeepSeek stub 的首字节延迟（秒）
+STUB_TOKEN_LATENCY = 0.005        # 流式输出时每个片段的间隔（秒）
+
+_VOCABULARY = (
+    'market order knowledge price signal competition planning freedom law liberty tradition rule '
+    'spontaneous dispersed information economy socialism money capital interest production '
+    'individual society government coercion evolution institution morality property contract '
+    'calculation equilibrium entrepreneur discovery prosperity civilization reason constructivism'
+).split()
+_TOPICS = ('中央计划经济', '自发秩序', '价格信号', '分散知识', '法治', '货币政策', '社会正义', '竞争', '传统与理性', '通货膨胀')
+
+# 由文本确定的伪随机单位向量：相同文本总是得到相同向量，不同文本近似正交
+def stub_vector(text: str, dim: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vec /= np.linalg.norm(vec)
+    return vec.tolist()
+
+def _stub_words(seed_text: str, count: int) -> List[str]:
+    rng = random.Random(seed_text)
+    return [rng.choice(_VOCABULARY) for _ in range(count)]
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive，使客户端的连接池与真实服务一样生效
+    config = {}
+
+    def log_message(self, format, *args):
+        pass  # 不打印访问日志
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _send_json(self, obj, status: int = 200) -> None:
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+# Ollama 的 /api/embed（批量）与 /api/embeddings（单条）接口
+class OllamaStubHandler(_StubHandler):
+    def do_POST(self):
+        body = self._read_json()
+        dim = self.config['embed_dim']
+        if self.path == '/api/embed':
+            texts = body.get('input') or []
+            if isinstance(texts, str):
+                texts = [texts]
+            time.sleep(self.config['embed_latency'] + self.config['embed_item_latency'] * len(texts))
+            self._send_json({'model': body.get('model'), 'embeddings': [stub_vector(t, dim) for t in texts]})
+        elif self.path == '/api/embeddings':
+            time.sleep(self.config['embed_latency'] + self.config['embed_item_latency'])
+            self._send_json({'embedding': stub_vector(body.get('prompt', ''), dim)})
+        else:
+            self._send_json({'error': f"unknown endpoint {self.path}"}, status=404)
+
+# DeepSeek chat completions：精炼 prompt 返回固定格式的三步结果，其余返回报告；支持 SSE 流式输出
+class DeepSeekStubHandler(_StubHandler):
+    def _reply_for(self, prompt: str) -> str:
+        if 'Refined Query' in prompt:
+            words = _stub_words(prompt, 8)
+            return (f"Step 1: Relevant to Hayek.\n"
+                    f"Step 2: Refined Query: {' '.join(words[:5])}\n"
+                    f"Step 3: Keywords: {', '.join(words[5:])}")
+        words = _stub_words(prompt, 300)
+        return "用户提问：...\n\n委员会意见：" + ' '.join(words) + "\n\nThis is AI-generated inspiration based on Hayek's works, not authoritative interpretation."
+
+    def do_POST(self):
+        body = self._read_json()
+        messages = body.get('messages') or [{}]
+        reply = self._reply_for(messages[-1].get('content', ''))
+        # 粗略的 token 数（约 4 字符一个 token），使 tracing 中的 usage 字段有值
+        usage = {'prompt_tokens': sum(len(m.get('content', '')) for m in messages) // 4, 'completion_tokens': len(reply) // 4}
+        time.sleep(self.config['llm_latency'])
+        if not body.get('stream'):
+            self._send_json({'choices': [{'message': {'role': 'assistant', 'content': reply}}], 'usage': usage})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pieces = reply.split(' ')
+        for i, piece in enumerate(pieces):
+            delta = piece if i == 0 else ' ' + piece
+            event = {'choices': [{'delta': {'content': delta}}]}
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            time.sleep(self.config['token_latency'])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b'')
+
+# 在后台线程启动 stub 服务，返回 (server, base_url)；端口由系统分配
+def start_stub_server(handler: type, config: dict):
+    handler_cls = type(handler.__name__, (handler,), {'config': config})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_cls)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# 生成合成语料：每本书一个 EPUB，章节内为由词表随机组成的段落（固定种子，结果可复现）
+def generate_corpus(data_dir: str, books: int, chapters: int, paragraphs: int) -> int:
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(0)
+    total_chars = 0
+    for b in range(books):
+        book = epub.EpubBook()
+        book.set_identifier(f"hayek-bench-{b:04d}")
+        book.set_title(f"Synthetic Book {b + 1}")
+        book.set_language('en')
+        items = []
+        for c in range(chapters):
+            paras = []
+            for _ in range(paragraphs):
+                sentences = [' '.join(rng.choice(_VOCABULARY) for _ in range(rng.randint(8, 20))).capitalize() + '.'
+                             for _ in range(rng.randint(3, 8))]
+                paras.append(' '.join(sentences))
+            total_chars += sum(len(p) for p in paras)
+            item = epub.EpubHtml(title=f"Chapter {c + 1}", file_name=f"chap_{c + 1:03d}.xhtml", lang='en')
+            item.content = f"<h1>Chapter {c + 1}</h1>" + ''.join(f"<p>{p}</p>" for p in paras)
+            book.add_item(item)
+            items.append(item)
+        book.toc = items
+        book.spine = ['nav'] + items
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+        epub.write_epub(os.path.join(data_dir, f"{b + 1:04d} Synthetic Book.epub"), book)
+    return total_chars
+
+def percentiles(samples: List[float]) -> dict:
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(np.mean(samples))}
+
+# 本进程及其子进程（提取进程池）的峰值常驻内存（MB）；不支持 resource 模块的平台返回 None
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss: macOS 以字节计，Linux 以 KB 计
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor,
+    }
+
+# 在独立子进程中运行一个规模的全部测量（峰值内存互不影响），结果写入 result_path
+def run_size(books: int, args, result_path: str) -> None:
+    chars = generate_corpus('data/test', books, args.chapters, args.paragraphs)
+
+    # 项目模块在子进程中导入：此时 OLLAMA_HOST / DEEPSEEK_API_URL 已指向 stub
+    import cache
+    cache.CACHE_ENABLED = args.with_cache  # 默认关闭缓存，测量的是冷路径
+    from indexing import build_index, load_index
+    from query_handler import refine_query, retrieve_chunks, handle_query
+    from index_cache import get_index
+    from tracing import recent_spans
+
+    start = time.perf_counter()
+    index, metadata = build_index()
+    build_seconds = time.perf_counter() - start
+    chunks = index.ntotal
+
+    start = time.perf_counter()
+    index, parents, subs = load_index()
+    load_seconds = time.perf_counter() - start
+
+    questions = [f"哈耶克如何看待{_TOPICS[i % len(_TOPICS)]}？（问题 {i + 1}）" for i in range(args.queries)]
+    english_queries = [refine_query(q)[0] for q in questions]
+    retrieve_latencies = []
+    for q in english_queries:
+        t = time.perf_counter()
+        retrieve_chunks(q, index, parents, subs)
+        retrieve_latencies.append(time.perf_counter() - t)
+    # 限定为一本书（只搜索一个分片）时的检索延迟
+    one_book_latencies = []
+    for q in english_queries:
+        t = time.perf_counter()
+        retrieve_chunks(q, index, parents, subs, sources=index.sources[:1])
+        one_book_latencies.append(time.perf_counter() - t)
+
+    get_index()  # 预热常驻索引，查询延迟不含首次加载
+    query_latencies = []
+    for q in questions:
+        t = time.perf_counter()
+        handle_query(q)
+        query_latencies.append(time.perf_counter() - t)
+    # 报告生成（流式）请求的 prompt token 数，来自 stub 返回的 usage
+    report_prompt_tokens = [r['attrs']['prompt_tokens'] for r in recent_spans('llm')
+                            if r['attrs'].get('stream') and r['attrs'].get('prompt_tokens') is not None]
+
+    result = {
+        'books': books,
+        'chars': chars,
+        'chunks': chunks,
+        'parents': len(metadata['parents']),
+        'build_seconds': build_seconds,
+        'chunks_per_sec': chunks / build_seconds if build_seconds else None,
+        'load_seconds': load_seconds,
+        'retrieve_latency': percentiles(retrieve_latencies),
+        'retrieve_one_book_latency': percentiles(one_book_latencies),
+        'query_latency': percentiles(query_latencies),
+        'report_prompt_tokens': float(np.mean(report_prompt_tokens)) if report_prompt_tokens else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def _fmt(value, spec: str = '.3f') -> str:
+    return '-' if value is None else format(value, spec)
+
+def print_results(runs: List[dict], baseline: dict = None) -> None:
+    base_by_books = {r['books']: r for r in (baseline or {}).get('runs', [])}
+    print(f"{'books':>6} {'chunks':>8} {'chunks/s':>10} {'load s':>8} {'retr p50':>9} {'retr p95':>9} {'1book p50':>9} "
+          f"{'query p50':>10} {'query p95':>10} {'query p99':>10} {'prompt tok':>10} {'rss MB':>8}")
+    for r in runs:
+        rss = r['peak_rss_mb']
+        peak = max(rss['self'], rss['children']) if rss else None
+        print(f"{r['books']:>6} {r['chunks']:>8} {_fmt(r['chunks_per_sec'], '.1f'):>10} {_fmt(r['load_seconds']):>8} "
+              f"{_fmt(r['retrieve_latency']['p50']):>9} {_fmt(r['retrieve_latency']['p95']):>9} "
+              f"{_fmt((r.get('retrieve_one_book_latency') or {}).get('p50')):>9} "
+              f"{_fmt(r['query_latency']['p50']):>10} {_fmt(r['query_latency']['p95']):>10} "
+              f"{_fmt(r['query_latency']['p99']):>10} {_fmt(r.get('report_prompt_tokens'), '.0f'):>10} {_fmt(peak, '.0f'):>8}")
+        base = base_by_books.get(r['books'])
+        if base:
+            # 与基线的相对变化（正数表示变慢/变大，chunks/s 正数表示变快）
+            def delta(new, old):
+                return f"{(new - old) / old * 100:+.1f}%" if new is not None and old else '-'
+            print(f"{'vs base':>6} {'':>8} {delta(r['chunks_per_sec'], base['chunks_per_sec']):>10} "
+                  f"{delta(r['load_seconds'], base['load_seconds']):>8} "
+                  f"{delta(r['retrieve_latency']['p50'], base['retrieve_latency']['p50']):>9} "
+                  f"{delta(r['retrieve_latency']['p95'], base['retrieve_latency']['p95']):>9} "
+                  f"{delta((r.get('retrieve_one_book_latency') or {}).get('p50'), (base.get('retrieve_one_book_latency') or {}).get('p50')):>9} "
+                  f"{delta(r['query_latency']['p50'], base['query_latency']['p50']):>10} "
+                  f"{delta(r['query_latency']['p95'], base['query_latency']['p95']):>10} "
+                  f"{delta(r['query_latency']['p99'], base['query_latency']['p99']):>10} "
+                  f"{delta(r.get('report_prompt_tokens'), base.get('report_prompt_tokens')):>10}")
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark with local Ollama/DeepSeek stubs.")
+    parser.add_argument('--sizes', default=','.join(map(str, BENCH_SIZES)), help="comma-separated numbers of synthetic books")
+    parser.add_argument('--chapters', type=int, default=BENCH_CHAPTERS)
+    parser.add_argument('--paragraphs', type=int, default=BENCH_PARAGRAPHS)
+    parser.add_argument('--queries', type=int, default=BENCH_QUERIES)
+    parser.add_argument('--embed-dim', type=int, default=STUB_EMBED_DIM)
+    parser.add_argument('--embed-latency', type=float, default=STUB_EMBED_LATENCY)
+    parser.add_argument('--embed-item-latency', type=float, default=STUB_EMBED_ITEM_LATENCY)
+    parser.add_argument('--llm-latency', type=float, default=STUB_LLM_LATENCY)
+    parser.add_argument('--token-latency', type=float, default=STUB_TOKEN_LATENCY)
+    parser.add_argument('--with-cache', action='store_true', help="keep cache.py enabled during the run")
+    parser.add_argument('--output', help="results JSON path (default: bench_results/bench_<time>_<commit>.json)")
+    parser.add_argument('--baseline', help="previous results JSON to compare against")
+    parser.add_argument('--verbose', action='store_true', help="show output of the benchmarked code")
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)     # 内部：子进程中运行单个规模
+    parser.add_argument('--result-path', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None) -> dict:
+    args = _parse_args(argv)
+    if args.run_size is not None:
+        run_size(args.run_size, args, args.result_path)
+        return {}
+
+    config = {
+        'embed_dim': args.embed_dim,
+        'embed_latency': args.embed_latency,
+        'embed_item_latency': args.embed_item_latency,
+        'llm_latency': args.llm_latency,
+        'token_latency': args.token_latency,
+    }
+    ollama_server, ollama_url = start_stub_server(OllamaStubHandler, config)
+    deepseek_server, deepseek_url = start_stub_server(DeepSeekStubHandler, config)
+    env = dict(os.environ, OLLAMA_HOST=ollama_url, DEEPSEEK_API_URL=deepseek_url + '/v1/chat/completions',
+               DEEPSEEK_API_KEY='benchmark-stub')
+    script = os.path.abspath(__file__)
+    runs = []
+    try:
+        for books in [int(s) for s in args.sizes.split(',') if s.strip()]:
+            print(f"Benchmarking {books} books...")
+            with tempfile.TemporaryDirectory(prefix='hayek_bench_') as workdir:
+                # 每个规模使用独立的工作目录（索引、块存储、缓存均为相对路径）与独立进程
+                result_path = os.path.join(workdir, 'result.json')
+                cmd = [sys.executable, script, '--run-size', str(books), '--result-path', result_path]
+                cmd += list(argv if argv is not None else sys.argv[1:])
+                output = None if args.verbose else subprocess.DEVNULL
+                proc = subprocess.run(cmd, cwd=workdir, env=env, stdout=output)
+                if proc.returncode != 0:
+                    raise RuntimeError(f"Benchmark for {books} books failed (exit code {proc.returncode}); rerun with --verbose.")
+                with open(result_path, 'r', encoding='utf-8') as f:
+                    runs.append(json.load(f))
+    finally:
+        ollama_server.shutdown()
+        deepseek_server.shutdown()
+
+    commit = _git_commit()
+    results = {
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict(config, chapters=args.chapters, paragraphs=args.paragraphs,
+                       queries=args.queries, with_cache=args.with_cache),
+        'runs': runs,
+    }
+    output_path = args.output
+    if not output_path:
+        os.makedirs(BENCH_RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(BENCH_RESULTS_DIR, f"bench_{time.strftime('%Y%m%d_%H%M%S')}_{commit or 'nogit'}.json")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(runs, baseline)
+    print(f"Results written to {output_path}")
+    return results
+
+if __name__ == "__main__":
+    main()
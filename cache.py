@@ -0,0 +1,150 @@
+# cache.py: 多级缓存（进程内 LRU + SQLite 磁盘层），用于问题精炼、查询 embedding 与完整报告
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# 常量
+CACHE_ENABLED = True
+CACHE_DB_FILE = 'hayek_cache.db'
+CACHE_MEMORY_ENTRIES = 512                 # 内存层最多保留的条目数（LRU）
+CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024   # 磁盘层总大小上限，超出时按最近访问时间淘汰
+CACHE_TTLS = {                             # 各命名空间的过期时间（秒）
+    'refine': 7 * 24 * 3600,
+    'embedding': 30 * 24 * 3600,
+    'report': 24 * 3600,
+    'answer': 24 * 3600,
+}
+DEFAULT_TTL = 24 * 3600
+_EVICT_EVERY = 50  # 每写入多少次检查一次磁盘层大小
+
+_MISSING = object()
+
+# 规范化问题文本：全/半角统一、合并空白，使仅有格式差异的问题命中同一缓存
+def normalize_question(question: str) -> str:
+    question = unicodedata.normalize('NFKC', question)
+    return re.sub(r'\s+', ' ', question).strip()
+
+# Function to build a cache key from a namespace and everything the cached value depends on
+def make_key(namespace: str, *parts) -> str:
+    payload = json.dumps([namespace, *parts], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class TieredCache:
+    def __init__(self, db_path: str = CACHE_DB_FILE,
+                 memory_entries: int = CACHE_MEMORY_ENTRIES,
+                 disk_max_bytes: int = CACHE_DISK_MAX_BYTES):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+
+    # 磁盘层惰性打开；失败时只用内存层，不影响查询
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, expires_at: float, value) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # 返回缓存值；未命中或已过期时返回 None
+    def get(self, namespace: str, key: str):
+        if not CACHE_ENABLED:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+            try:
+                conn = self._db()
+                row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if row[1] <= now:
+                    conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    conn.commit()
+                    return None
+                conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Cache read error ({namespace}): {e}")
+                return None
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            return value
+
+    # 写入两级缓存；value 需可 JSON 序列化
+    def set(self, namespace: str, key: str, value, ttl: float = None) -> None:
+        if not CACHE_ENABLED:
+            return
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else CACHE_TTLS.get(namespace, DEFAULT_TTL))
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            try:
+                conn = self._db()
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, namespace, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, namespace, payload, len(payload.encode('utf-8')), expires_at, now))
+                conn.commit()
+                self._writes += 1
+                if self._writes % _EVICT_EVERY == 0:
+                    self._evict(conn, now)
+            except sqlite3.Error as e:
+                print(f"Cache write error ({namespace}): {e}")
+
+    # 删除过期条目，并按最近访问时间淘汰到大小上限以内
+    def _evict(self, conn, now: float) -> None:
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total > self.disk_max_bytes:
+            excess = total - self.disk_max_bytes
+            removed = 0
+            stale_keys = []
+            cursor = conn.execute("SELECT key, size FROM cache ORDER BY accessed_at")
+            for key, size in cursor:
+                stale_keys.append((key,))
+                removed += size
+                if removed >= excess:
+                    break
+            cursor.close()
+            conn.executemany("DELETE FROM cache WHERE key = ?", stale_keys)
+        conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            try:
+                self._db().execute("DELETE FROM cache")
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"Cache clear error: {e}")
+
+_default_cache = TieredCache()
+
+# Function to get the process-wide cache
+def get_cache() -> TieredCache:
+    return _default_cache
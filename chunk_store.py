@@ -0,0 +1,201 @@
+# chunk_store.py: 基于 SQLite 的紧凑块存储（替代 hayek_metadata.json），按 ID 惰性读取父块/子块
+import os
+import json
+import sqlite3
+import threading
+from collections import Counter
+from typing import Iterable, List, Optional
+
+# 常量
+CHUNK_DB_FILE = 'hayek_chunks.db'
+MMAP_SIZE = 1 << 30  # 读连接的内存映射上限（1GB），多个进程共享操作系统页缓存
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS parents (
+    id INTEGER PRIMARY KEY,
+    source_file TEXT NOT NULL,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subs (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER NOT NULL,
+    source_file TEXT NOT NULL,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parents_source ON parents(source_file);
+CREATE INDEX IF NOT EXISTS subs_source ON subs(source_file);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+def _row_to_chunk(row) -> dict:
+    return {'text': row[1], 'metadata': json.loads(row[2])}
+
+# 只读视图，行为类似旧的 parents/subs 列表：下标 = ID - 1，已删除的位置返回 None
+class ChunkTable:
+    def __init__(self, store: 'ChunkStore', table: str):
+        self._store = store
+        self._table = table
+
+    def __len__(self) -> int:
+        return self._store.last_id(self._table)
+
+    def __getitem__(self, pos: int) -> Optional[dict]:
+        if not 0 <= pos < len(self):
+            raise IndexError(f"{self._table} index out of range")
+        row = self._store.fetchone(f"SELECT id, text, metadata FROM {self._table} WHERE id = ?", (pos + 1,))
+        return _row_to_chunk(row) if row else None
+
+    # 一次查询取回多个位置，按输入顺序返回（缺失的为 None）
+    def get_many(self, positions: Iterable[int]) -> List[Optional[dict]]:
+        positions = list(positions)
+        if not positions:
+            return []
+        placeholders = ','.join('?' * len(positions))
+        rows = self._store.fetchall(
+            f"SELECT id, text, metadata FROM {self._table} WHERE id IN ({placeholders})",
+            [p + 1 for p in positions])
+        by_id = {row[0]: _row_to_chunk(row) for row in rows}
+        return [by_id.get(p + 1) for p in positions]
+
+    def __iter__(self):
+        rows = self._store.fetchall(f"SELECT id, text, metadata FROM {self._table} ORDER BY id")
+        expected = 1
+        for row in rows:
+            while expected < row[0]:
+                yield None
+                expected += 1
+            yield _row_to_chunk(row)
+            expected += 1
+
+# buffered=True 时写操作（插入/删除）先缓存在内存中，commit() 时在一个短事务里一次写入：
+# 增量构建在 embedding 期间（可能数小时）不持有写锁，读取方一直能读到旧数据
+class ChunkStore:
+    def __init__(self, path: str = CHUNK_DB_FILE, readonly: bool = True, buffered: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._pending = [] if buffered and not readonly else None  # 待写入的 (sql, params)
+        if readonly:
+            if not os.path.exists(path):
+                raise ValueError(f"Chunk store '{path}' not found.")
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        self._lock = threading.RLock()  # Streamlit 多会话线程共享同一连接
+        self._last_ids = {}
+        self.parents = ChunkTable(self, 'parents')
+        self.subs = ChunkTable(self, 'subs')
+
+    def fetchone(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # 已分配过的最大 ID（删除不回收，保证 ID 单调递增）；只读连接上即为快照内的固定值
+    def last_id(self, table: str) -> int:
+        if table not in self._last_ids:
+            row = self.fetchone("SELECT value FROM counters WHERE name = ?", (table,))
+            self._last_ids[table] = row[0] if row else 0
+        return self._last_ids[table]
+
+    def _write(self, sql: str, params=()) -> None:
+        if self._pending is not None:
+            self._pending.append((sql, params))
+        else:
+            self._conn.execute(sql, params)
+
+    def _bump(self, table: str, chunk_id: int) -> None:
+        self._last_ids[table] = max(self.last_id(table), chunk_id)
+        self._write(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)", (table, chunk_id))
+
+    def insert_parent(self, parent_id: int, source_file: str, text: str, metadata: dict) -> None:
+        with self._lock:
+            self._write("INSERT INTO parents (id, source_file, text, metadata) VALUES (?, ?, ?, ?)",
+                               (parent_id, source_file, text, json.dumps(metadata, ensure_ascii=False)))
+            self._bump('parents', parent_id)
+
+    def insert_sub(self, sub_id: int, parent_id: int, source_file: str, text: str, metadata: dict) -> None:
+        with self._lock:
+            self._write("INSERT INTO subs (id, parent_id, source_file, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                               (sub_id, parent_id, source_file, text, json.dumps(metadata, ensure_ascii=False)))
+            self._bump('subs', sub_id)
+
+    # 给定文档的全部子块位置（即 FAISS id）
+    def sub_positions_for_sources(self, sources: Iterable[str]) -> List[int]:
+        sources = list(sources)
+        placeholders = ','.join('?' * len(sources))
+        rows = self.fetchall(f"SELECT id FROM subs WHERE source_file IN ({placeholders})", sources)
+        return [row[0] - 1 for row in rows]
+
+    # 全部现存子块的位置（即 FAISS id），升序
+    def sub_positions(self) -> List[int]:
+        return [row[0] - 1 for row in self.fetchall("SELECT id FROM subs ORDER BY id")]
+
+    def delete_sources(self, sources: Iterable[str]) -> None:
+        sources = list(sources)
+        placeholders = ','.join('?' * len(sources))
+        with self._lock:
+            self._write(f"DELETE FROM subs WHERE source_file IN ({placeholders})", sources)
+            self._write(f"DELETE FROM parents WHERE source_file IN ({placeholders})", sources)
+
+    def parent_counts(self) -> Counter:
+        return Counter(dict(self.fetchall("SELECT source_file, COUNT(*) FROM parents GROUP BY source_file")))
+
+    # 读取（如 parent_counts）只看到已提交的数据；buffered 模式下缓存的写操作在这里一次写入
+    def commit(self) -> None:
+        with self._lock:
+            if self._pending:
+                with self._conn:  # 出错时回滚，库中仍是旧数据
+                    for sql, params in self._pending:
+                        self._conn.execute(sql, params)
+                self._pending.clear()
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __del__(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+
+# Function to migrate the legacy hayek_metadata.json into the chunk store (one-shot)
+def migrate_json_metadata(json_path: str, db_path: str = CHUNK_DB_FILE) -> None:
+    print(f"Migrating {json_path} -> {db_path} ...")
+    with open(json_path, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    store = ChunkStore(tmp_path, readonly=False)
+    # 旧文件中 ID = 列表位置 + 1（增量删除的位置为 null），迁移后保持不变，FAISS 索引无需重建
+    for pos, parent in enumerate(metadata['parents']):
+        if parent:
+            store.insert_parent(pos + 1, parent['metadata']['source_file'], parent['text'], parent['metadata'])
+    for pos, sub in enumerate(metadata['subs']):
+        if sub:
+            store.insert_sub(pos + 1, sub['metadata']['parent_id'], sub['metadata']['source_file'], sub['text'], sub['metadata'])
+    store._bump('parents', len(metadata['parents']))
+    store._bump('subs', len(metadata['subs']))
+    store.commit()
+    store.close()
+    os.replace(tmp_path, db_path)
+    print(f"Migrated {len(metadata['parents'])} parents and {len(metadata['subs'])} subs; {json_path} is no longer used.")
+
+# 单独运行时执行迁移
+if __name__ == "__main__":
+    from indexing import METADATA_FILE
+    migrate_json_metadata(METADATA_FILE)
@@ -0,0 +1,118 @@
+# context_packing.py: 报告上下文打包（保持检索排名、合并同源相邻/重叠父块、去除近似重复、按 token 预算截断）
+import re
+from typing import List
+
+# 常量
+CONTEXT_TOKEN_BUDGET = 1800    # 报告 prompt 中检索上下文的 token 预算（估算值）
+MERGE_MAX_GAP = 200            # 同一文档中两个父块相距不超过该字符数时合并为一段
+DUPLICATE_THRESHOLD = 0.8      # 词 shingle 包含度超过该值的段落视为近似重复，保留排名靠前的一段
+SHINGLE_SIZE = 3               # shingle 的词数
+MIN_PARTIAL_TOKENS = 80        # 剩余预算低于该值时不再截断放入后续段落
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]')
+_WORD = re.compile(r'\w+')
+_SENTENCE_END = re.compile(r'[.?!。？！]["\')\]]?\s')
+
+# 粗略估算 token 数：中日韩字符约 1 字符 1 token，其余约 4 字符 1 token（无需加载 tokenizer）
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _shingles(text: str) -> set:
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+# 包含度：交集占较小集合的比例，一段被另一段基本包含时接近 1
+def _containment(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+def _passage(chunk: dict) -> dict:
+    meta = chunk.get('metadata') or {}
+    return {
+        'source': meta.get('source_file'),
+        'start': meta.get('char_start'),  # 旧索引没有 offset，只做去重
+        'end': meta.get('char_end'),
+        'text': chunk['text'],
+        'anchor': 0,  # 排名最靠前的父块在合并后文本中的起点，截断时从这里保留
+    }
+
+def _can_merge(a: dict, b: dict) -> bool:
+    if a['source'] != b['source'] or a['start'] is None or b['start'] is None:
+        return False
+    return b['start'] <= a['end'] + MERGE_MAX_GAP and a['start'] <= b['end'] + MERGE_MAX_GAP
+
+# 把 p 并入 m（同源、区间相交或相邻），文本按文档顺序拼接；offset 与 data/processed 中的全文一致，重叠部分只保留一份
+def _merge_into(m: dict, p: dict) -> None:
+    first, second = (m, p) if m['start'] <= p['start'] else (p, m)
+    if second['start'] < first['end']:
+        second_offset = second['start'] - first['start']
+        text = first['text'] + second['text'][first['end'] - second['start']:] if second['end'] > first['end'] else first['text']
+    else:
+        second_offset = len(first['text']) + 2
+        text = first['text'] + '\n\n' + second['text']
+    anchor = m['anchor'] + (second_offset if second is m else 0)
+    m.update(start=first['start'], end=max(first['end'], second['end']), text=text, anchor=anchor)
+
+# 在 max_tokens 以内截断，从 anchor 开始保留，尽量切在句末
+def _truncate(text: str, max_tokens: int, anchor: int = 0) -> str:
+    if max_tokens <= 0:
+        return ''
+    text = text[anchor:]
+    while text and estimate_tokens(text) > max_tokens:
+        cut = max(1, int(len(text) * max_tokens / estimate_tokens(text)))
+        ends = [m.end() for m in _SENTENCE_END.finditer(text, 0, cut)]
+        if ends and ends[-1] > cut // 2:
+            cut = ends[-1]
+        else:
+            space = text.rfind(' ', 0, cut)
+            cut = space if space > cut // 2 else cut
+        text = text[:cut].rstrip()
+    return text
+
+# Function to pack retrieved parents into report context
+# chunks 按检索排名排列；返回按排名排列的段落文本，总估算 token 数不超过 token_budget
+# 排名第一的证据总会保留（超出预算时截断），其余段落在预算不足时截断或跳过
+def pack_context(chunks: List[dict], token_budget: int = CONTEXT_TOKEN_BUDGET) -> List[str]:
+    merged = []
+    for chunk in chunks:
+        p = _passage(chunk)
+        for i, m in enumerate(merged):
+            if _can_merge(m, p):
+                _merge_into(m, p)
+                # p 可能连接了两个已有段落（如 [0,2000]、[3800,5800] 之间的 [1900,3900]）：把排名靠后、现在可合并的段落并入 m，直到不再变化
+                j = i + 1
+                while j < len(merged):
+                    if _can_merge(m, merged[j]):
+                        _merge_into(m, merged.pop(j))
+                        j = i + 1
+                    else:
+                        j += 1
+                break
+        else:
+            merged.append(p)
+
+    packed = []
+    kept_shingles = []
+    used = 0
+    for p in merged:
+        shingles = _shingles(p['text'])
+        if any(_containment(shingles, k) >= DUPLICATE_THRESHOLD for k in kept_shingles):
+            continue
+        text = p['text']
+        tokens = estimate_tokens(text)
+        remaining = token_budget - used
+        if tokens > remaining:
+            if packed and remaining < MIN_PARTIAL_TOKENS:
+                continue  # 后面更短的段落可能仍放得下
+            text = _truncate(text, remaining, p['anchor'])
+            tokens = estimate_tokens(text)
+            if not text:
+                continue
+        packed.append(text)
+        kept_shingles.append(shingles)
+        used += tokens
+    return packed
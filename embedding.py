@@ -0,0 +1,164 @@
+# embedding.py: 批量、并发的 Ollama embedding 流水线（带重试与断点续传），以及 float16 原始向量 sidecar 的读写
+import os
+import time
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, List
+import numpy as np
+import ollama
+
+# 常量
+EMBED_BATCH_SIZE = 64           # 每次请求发送的 chunk 数
+EMBED_CONCURRENCY = 4           # 同时在途的请求数上限
+EMBED_MAX_RETRIES = 5           # 单个 batch 的最大重试次数
+EMBED_RETRY_BASE_DELAY = 1.0    # 指数退避的基准秒数
+EMBED_CHECKPOINT_DIR = 'data/embeddings_checkpoint'  # 已完成 batch 的落盘目录
+SIDECAR_COPY_ROWS = 65536       # 增量更新 sidecar 时每次复制的行数
+
+# 以 (模型, batch 内全部文本) 计算 batch 的内容指纹，作为 checkpoint 文件名
+def _batch_key(model: str, texts: List[str]) -> str:
+    h = hashlib.sha256(model.encode('utf-8'))
+    for t in texts:
+        h.update(b'\x00')
+        h.update(t.encode('utf-8'))
+    return h.hexdigest()
+
+def _checkpoint_path(checkpoint_dir: str, key: str) -> str:
+    return os.path.join(checkpoint_dir, f"{key}.npy")
+
+# 原子写入：先写临时文件再 rename，避免崩溃时留下半个文件
+def _save_checkpoint(path: str, embeddings: np.ndarray) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(tmp_path, path)
+
+def _load_checkpoint(path: str, expected_rows: int):
+    try:
+        arr = np.load(path)
+    except (OSError, ValueError):
+        return None  # 损坏的文件视为未完成
+    if arr.ndim != 2 or arr.shape[0] != expected_rows:
+        return None
+    return arr
+
+# 单个 batch 的 embedding 请求，失败时指数退避 + 抖动重试
+def _embed_batch(texts: List[str], model: str, start: int, checkpoint_dir: str) -> np.ndarray:
+    key = _batch_key(model, texts)
+    path = _checkpoint_path(checkpoint_dir, key) if checkpoint_dir else None
+    if path and os.path.exists(path):
+        cached = _load_checkpoint(path, len(texts))
+        if cached is not None:
+            return cached
+
+    last_error = None
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            response = ollama.embed(model=model, input=texts)
+            embeddings = np.array(response['embeddings'], dtype=np.float32)
+            if embeddings.shape[0] != len(texts):
+                raise ValueError(f"expected {len(texts)} embeddings, got {embeddings.shape[0]}")
+            if path:
+                _save_checkpoint(path, embeddings)
+            return embeddings
+        except Exception as e:
+            last_error = e
+            if attempt < EMBED_MAX_RETRIES:
+                delay = EMBED_RETRY_BASE_DELAY * (2 ** attempt)
+                delay += random.uniform(0, delay / 2)
+                print(f"Embedding batch at chunk {start} failed ({e}), retrying in {delay:.1f}s...")
+                time.sleep(delay)
+    raise ValueError(f"Ollama embedding error for batch starting at chunk {start}: {last_error}.")
+
+# Function to embed texts in batches with bounded concurrency
+# texts 可以是任意可迭代对象（按需消费），返回与输入顺序一致的 float32 矩阵
+# progress=False 时不打印进度（查询时的 embedding 每次只有一两条）
+def embed_texts(texts: Iterable[str], model: str,
+                batch_size: int = EMBED_BATCH_SIZE,
+                concurrency: int = EMBED_CONCURRENCY,
+                checkpoint_dir: str = EMBED_CHECKPOINT_DIR,
+                progress: bool = True) -> np.ndarray:
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    results = {}  # batch 起始位置 -> embeddings
+    pending = set()
+    total = 0
+    done = 0
+
+    def collect(finished) -> None:
+        nonlocal done
+        for fut in finished:
+            start, arr = fut.result()  # 重试耗尽时抛出 ValueError
+            results[start] = arr
+            done += arr.shape[0]
+            if progress:
+                print(f"Embedded {done} chunks so far ({total} queued)")
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        def submit(batch: List[str], start: int) -> None:
+            fut = executor.submit(lambda: (start, _embed_batch(batch, model, start, checkpoint_dir)))
+            pending.add(fut)
+
+        batch = []
+        for text in texts:
+            batch.append(text)
+            total += 1
+            if len(batch) >= batch_size:
+                # 在途请求达到上限时，先等至少一个完成再继续提交
+                while len(pending) >= concurrency:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.difference_update(finished)
+                    collect(finished)
+                submit(batch, total - len(batch))
+                batch = []
+        if batch:
+            submit(batch, total - len(batch))
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending.difference_update(finished)
+            collect(finished)
+
+    if not results:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack([results[start] for start in sorted(results)])
+
+# 索引成功保存后清理 checkpoint 目录
+def clear_checkpoints(checkpoint_dir: str = EMBED_CHECKPOINT_DIR) -> None:
+    if not checkpoint_dir or not os.path.isdir(checkpoint_dir):
+        return
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.npy') or name.endswith('.tmp'):
+            os.remove(os.path.join(checkpoint_dir, name))
+
+# Function to write the float16 embedding sidecar（第 i 行为 FAISS id = i 的向量，可用 np.load(mmap_mode='r') 映射读取）
+# update=True 时先原样复制旧 sidecar（已删除位置的行保留但不再被引用），旧文件不存在则不写并返回 False
+# 先写临时文件再原子替换
+def save_embedding_sidecar(path: str, embeddings: np.ndarray, ids: np.ndarray, rows: int, update: bool = False) -> bool:
+    previous = load_embedding_sidecar(path) if update else None
+    if update and previous is None:
+        return False
+    dim = embeddings.shape[1] if len(ids) else previous.shape[1]
+    tmp_path = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(rows, dim))
+    if previous is not None:
+        copy_rows = min(previous.shape[0], rows)
+        for start in range(0, copy_rows, SIDECAR_COPY_ROWS):
+            end = min(start + SIDECAR_COPY_ROWS, copy_rows)
+            out[start:end] = previous[start:end]
+    if len(ids):
+        out[ids] = embeddings.astype(np.float16)
+    out.flush()
+    del out, previous  # 先关闭映射（Windows 上被映射的文件不能被替换）
+    os.replace(tmp_path, path)
+    return True
+
+# Function to memory-map the embedding sidecar (read-only); 文件不存在或损坏时返回 None
+def load_embedding_sidecar(path: str):
+    try:
+        arr = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return arr if arr.ndim == 2 else None
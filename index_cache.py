@@ -0,0 +1,86 @@
+# index_cache.py: 进程内常驻的索引缓存（app.py 与 main.py 共用），磁盘上的索引变化时原子热切换
+import os
+import time
+import threading
+from typing import NamedTuple, Optional
+from vector_index import ShardedIndex
+from indexing import load_index, read_index, current_index_version, MANIFEST_FILE
+from chunk_store import ChunkTable
+
+INDEX_CHECK_INTERVAL = 5.0  # 两次检查磁盘变化的最小间隔（秒）
+
+# 一次加载得到的不可变快照；查询全程持有同一个快照，热切换不会影响进行中的查询
+class IndexSnapshot(NamedTuple):
+    index: ShardedIndex
+    parents: ChunkTable
+    subs: ChunkTable
+    version: Optional[str]
+
+# manifest 的 (mtime, size)，只用于判断是否需要重新读取 manifest
+# 构建依次替换块存储、sidecar、分片，最后才写 manifest；只有 manifest 中的 index_version 变化才说明一次构建已全部落盘
+def _manifest_signature():
+    try:
+        st = os.stat(MANIFEST_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+class IndexCache:
+    def __init__(self, check_interval: float = INDEX_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._signature = None
+        self._last_check = 0.0
+        self._load_lock = threading.Lock()
+
+    # 返回当前快照；首次调用时加载（必要时构建/增量更新），之后按间隔检查磁盘变化
+    def get(self) -> IndexSnapshot:
+        if self._snapshot is None:
+            with self._load_lock:
+                if self._snapshot is None:
+                    index, parents, subs = load_index()
+                    self._install(IndexSnapshot(index, parents, subs, current_index_version()), _manifest_signature())
+        elif time.monotonic() - self._last_check >= self.check_interval:
+            self._maybe_reload()
+        return self._snapshot
+
+    def _install(self, snapshot: IndexSnapshot, signature: tuple) -> None:
+        self._signature = signature
+        self._last_check = time.monotonic()
+        self._snapshot = snapshot  # 单次引用赋值，对读取方是原子的
+
+    def _maybe_reload(self) -> None:
+        # 已有线程在重新加载时直接返回，继续使用旧快照，不阻塞查询
+        if not self._load_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_check = time.monotonic()
+            signature = _manifest_signature()
+            if signature == self._signature or signature is None:
+                return
+            try:
+                version = current_index_version()
+                if version == self._snapshot.version:
+                    self._signature = signature  # manifest 只是刷新了 mtime 等（索引未重建）
+                    return
+                index, parents, subs = read_index()
+            except Exception as e:
+                print(f"Index reload failed, keeping current index: {e}")
+                return
+            # 加载期间又完成了一次构建，丢弃本次结果，下次再试
+            if current_index_version() != version:
+                return
+            self._install(IndexSnapshot(index, parents, subs, version), signature)
+            print(f"Index reloaded (version {version}).")
+        finally:
+            self._load_lock.release()
+
+    # 强制下次 get() 时检查磁盘（例如刚在本进程内重建完索引）
+    def invalidate(self) -> None:
+        self._last_check = 0.0
+
+_default_cache = IndexCache()
+
+# Function to get the process-wide index snapshot
+def get_index() -> IndexSnapshot:
+    return _default_cache.get()
@@ -1,128 +1,547 @@
-# indexing.py: 处理文档向量化与 FAISS 索引构建/加载（使用 Ollama embedding）
+# indexing.py: 处理文档向量化与 FAISS 索引构建/加载（使用 Ollama embedding，每个文档一个索引分片）
 import os
 import json
+import time
+import uuid
+import hashlib
+import tempfile
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 import faiss
 import numpy as np
-import ollama
-from utils import extract_text_from_pdf, extract_text_from_epub, recursive_split_text  # 导入 utils 中的函数
+from typing import Iterable, Iterator, List, Tuple
+from utils import iter_pdf_pages, iter_epub_documents, iter_chunks, UNIT_SEPARATOR  # 导入 utils 中的函数
+from embedding import embed_texts, clear_checkpoints, save_embedding_sidecar, load_embedding_sidecar  # 批量 embedding 流水线与原始向量 sidecar
+from chunk_store import ChunkStore, CHUNK_DB_FILE, migrate_json_metadata  # 父块/子块存储
+from vector_index import ShardedIndex, create_index, add_vectors, configure_search, read_index_file, reconstruct_vectors, evaluate_index, compare_index_types, print_index_report
+from tracing import span  # 分阶段计时
 
 # 常量
-INDEX_FILE = 'hayek_index.faiss'
-METADATA_FILE = 'hayek_metadata.json'
+SHARD_DIR = 'hayek_shards'  # 每个文档一个 FAISS 索引分片（文件名见 _shard_file），由 manifest 记录
+METADATA_FILE = 'hayek_metadata.json'  # 旧版 metadata，仅用于一次性迁移到 CHUNK_DB_FILE
+LEGACY_INDEX_FILE = 'hayek_index.faiss'  # 旧版单一索引（基线为 IndexFlatL2，行号 = 子块位置），仅用于迁移时取回向量
+MANIFEST_FILE = 'hayek_manifest.json'  # 记录每个文档的 hash、分块参数与 embedding 模型，用于增量更新
+INDEX_REPORT_FILE = 'hayek_index_report.json'  # 构建时的召回率/延迟/大小报告
+EMBEDDINGS_FILE = 'hayek_embeddings.npy'  # float16 原始向量（第 i 行 = FAISS id i），切换索引类型时据此重建而无需重新 embedding
+INDEX_TYPE = 'flat'       # FAISS 索引类型：flat / sq8 / sq_fp16 / ivf_flat / ivf_sq8 / ivf_pq / hnsw（参数见 vector_index.py）
+TOP_K = 5                 # 检索 top-5 chunks
+DATA_DIR = 'data/test'
+PROCESSED_DIR = 'data/processed'  # 保存提取文本的目录
 EMBEDDING_MODEL = 'embeddinggemma:300m-qat-q4_0'
 PARENT_CHUNK_SIZE = 2000  # 父块大小
 SUB_CHUNK_SIZE = 500      # 子块大小
+PARENT_OVERLAP = 100      # 父块重叠
+SUB_OVERLAP = 50          # 子块重叠
 MIN_CHUNK_LENGTH = 100    # 已有的最小长度
+EXTRACT_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # 提取/分块进程数（留一个核给主进程与 embedding）
+MANIFEST_VERSION = 3      # 2: 流式分块，metadata 记录真实页码与字符 offset；3: 按文档分片的索引
 
-# Function to build index
-def build_index() -> tuple:
-    data_dir = 'data/test'
-    processed_dir = 'data/processed'  # 保存提取文本的目录
-    if not os.path.exists(processed_dir):
-        os.makedirs(processed_dir)  # 创建目录如果不存在
-    
+# 影响分块/向量结果的全部设置；任何一项变化都需要全量重建
+def _index_settings() -> dict:
+    return {
+        'manifest_version': MANIFEST_VERSION,
+        'embedding_model': EMBEDDING_MODEL,
+        'parent_chunk_size': PARENT_CHUNK_SIZE,
+        'sub_chunk_size': SUB_CHUNK_SIZE,
+        'parent_overlap': PARENT_OVERLAP,
+        'sub_overlap': SUB_OVERLAP,
+        'min_chunk_length': MIN_CHUNK_LENGTH,
+        'index_type': INDEX_TYPE,
+    }
+
+# 只有索引类型或索引布局（版本 2 的单一索引 -> 3 的分片）变化：可以用 EMBEDDINGS_FILE 重建索引，无需重新 embedding
+def _only_index_changed(manifest: dict) -> bool:
+    old = dict(manifest.get('settings') or {})
+    new = _index_settings()
+    if old == new or old.get('manifest_version') not in (2, MANIFEST_VERSION):
+        return False
+    for key in ('manifest_version', 'index_type'):
+        old.pop(key, None)
+        new.pop(key)
+    return old == new
+
+# 分片文件名只由文档名决定，同一文档重建时原子替换同一个文件
+def _shard_file(doc: str) -> str:
+    return hashlib.sha1(doc.encode('utf-8')).hexdigest()[:16] + '.faiss'
+
+def _shard_path(doc: str) -> str:
+    return os.path.join(SHARD_DIR, _shard_file(doc))
+
+# manifest 中记录了分片但文件已不存在（例如被手动删除以便单独重建）的文档
+def _missing_shards(manifest: dict) -> set:
+    return set(doc for doc, info in manifest['documents'].items()
+               if info.get('shard') and not os.path.exists(os.path.join(SHARD_DIR, info['shard'])))
+
+# 删除 manifest 不再引用的分片文件（已删除的文档、上次中断留下的临时文件）
+def _remove_unused_shards(manifest: dict) -> None:
+    used = set(info.get('shard') for info in manifest['documents'].values())
+    for name in os.listdir(SHARD_DIR):
+        if name not in used:
+            os.remove(os.path.join(SHARD_DIR, name))
+
+# Function to build one document's shard (ids 为全局子块位置，与块存储一致)
+def _build_shard(vectors: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    index = create_index(INDEX_TYPE, vectors)  # 用 ID 映射；IVF 类型在此训练（小文档自动退回 flat）
+    add_vectors(index, vectors, ids)
+    configure_search(index)
+    return index
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _list_documents(data_dir: str) -> List[str]:
     if not os.path.exists(data_dir):
         raise ValueError(f"'{data_dir}' folder not found in the current directory.")
-    
-    all_files = os.listdir(data_dir)
-    # print(f"Found {len(all_files)} files in '{data_dir}': {all_files[:5]}...")  
-    
-    documents = [f for f in all_files if f.lower().endswith(('.pdf', '.epub'))]
-    if not documents:
-        raise ValueError(f"No PDF or EPUB documents found in '{data_dir}' folder.")
-
-    all_parent_chunks = []  # list of {'text': str, 'metadata': dict}
-    all_sub_chunks = []     # list of {'text': str, 'metadata': dict, 'parent_id': int}
-    global_parent_id = 0
-    global_sub_id = 0
+    # 排序保证 parent_id / sub_id 的编号在不同机器上一致
+    return sorted(f for f in os.listdir(data_dir) if f.lower().endswith(('.pdf', '.epub')))
 
+# 计算文档状态；size 与 mtime 未变时直接复用 manifest 中的 hash，避免每次都读整本书
+def _document_states(data_dir: str, documents: List[str], known: dict) -> dict:
+    states = {}
     for doc in documents:
-        full_path = os.path.join(data_dir, doc)
-        if doc.lower().endswith('.pdf'):
-            text = extract_text_from_pdf(full_path)
-        elif doc.lower().endswith('.epub'):
-            text = extract_text_from_epub(full_path)
+        st = os.stat(os.path.join(data_dir, doc))
+        old = known.get(doc)
+        if old and old.get('size') == st.st_size and old.get('mtime') == st.st_mtime_ns:
+            sha = old['sha256']
         else:
-            continue
-        
-        # 保存提取的文本到 txt
-        txt_filename = os.path.splitext(doc)[0] + '.txt'  # e.g., book.pdf -> book.txt
-        txt_path = os.path.join(processed_dir, txt_filename)
-        with open(txt_path, 'w', encoding='utf-8') as txt_file:
-            txt_file.write(text)
-        print(f"Saved extracted text to {txt_path}")
-        
-        # 先分父块（大段落）
-        parent_chunks = recursive_split_text(text, max_chunk_size=PARENT_CHUNK_SIZE, overlap=100)  # 用大 size
-        filtered_parents = [p for p in parent_chunks if len(p) >= MIN_CHUNK_LENGTH * 2]  # 父块至少大点
-        
-        for local_parent_id, parent_text in enumerate(filtered_parents):
-            global_parent_id += 1
-            parent_metadata = {
-                'source_file': doc,
-                'chunk_id': f"parent_{global_parent_id:04d}",
-                'page_estimate': local_parent_id + 1
-            }
-            all_parent_chunks.append({'text': parent_text, 'metadata': parent_metadata})
-            
-            # 从父块分子块
-            sub_chunks = recursive_split_text(parent_text, max_chunk_size=SUB_CHUNK_SIZE, overlap=50)
-            filtered_subs = [s for s in sub_chunks if len(s) >= MIN_CHUNK_LENGTH]
-            
-            for sub_text in filtered_subs:
-                global_sub_id += 1
-                sub_metadata = {
-                    'source_file': doc,
-                    'chunk_id': f"sub_{global_sub_id:04d}",
-                    'page_estimate': local_parent_id + 1,
-                    'parent_id': global_parent_id  # 链接到父
-                }
-                all_sub_chunks.append({'text': sub_text, 'metadata': sub_metadata})
-    
-    if not all_sub_chunks:
-        raise ValueError("No sub-chunks extracted.")
+            sha = _file_sha256(os.path.join(data_dir, doc))
+        states[doc] = {'sha256': sha, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+    return states
+
+def _load_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# 原子写入：先写临时文件再 rename，读取方不会看到写了一半的文件
+def _write_json_atomic(path: str, obj) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _write_index_atomic(index, path: str) -> None:
+    tmp_path = path + '.tmp'
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+def _iter_units(full_path: str) -> Iterator[Tuple[int, str]]:
+    if full_path.lower().endswith('.pdf'):
+        return iter_pdf_pages(full_path)
+    return iter_epub_documents(full_path)
+
+# 流式提取并切分单个文档，产出 (parent, [sub, ...])，每个块为 {'text', 'start', 'end', 'page', 'page_end'}
+# start/end 是块在 data/processed 中保存的全文里的字符 offset；page 为 PDF 页码或 EPUB 章节序号
+# 提取文本逐页写入 txt，只记录每页的起始 offset，整本书不会同时驻留内存
+def _iter_document_parents(data_dir: str, processed_dir: str, doc: str) -> Iterator[Tuple[dict, List[dict]]]:
+    full_path = os.path.join(data_dir, doc)
+    txt_filename = os.path.splitext(doc)[0] + '.txt'  # e.g., book.pdf -> book.txt
+    txt_path = os.path.join(processed_dir, txt_filename)
+    unit_starts, unit_numbers = [], []
+
+    def page_of(offset: int) -> int:
+        return unit_numbers[bisect_right(unit_starts, offset) - 1]
+
+    def _located(text: str, start: int, end: int) -> dict:
+        return {'text': text, 'start': start, 'end': end, 'page': page_of(start), 'page_end': page_of(end - 1)}
+
+    with open(txt_path, 'w', encoding='utf-8') as txt_file:
+        # 与 iter_chunks 的 offset 规则一致：非空单元之间以 UNIT_SEPARATOR 连接
+        def units() -> Iterator[str]:
+            offset = 0
+            for number, text in _iter_units(full_path):
+                if not text:
+                    continue
+                if unit_starts:
+                    txt_file.write(UNIT_SEPARATOR)
+                    offset += len(UNIT_SEPARATOR)
+                unit_starts.append(offset)
+                unit_numbers.append(number)
+                txt_file.write(text)
+                offset += len(text)
+                yield text
+
+        # 先分父块（大段落），再从父块分子块；子块 offset 换算回全文
+        for parent in iter_chunks(units(), max_chunk_size=PARENT_CHUNK_SIZE, overlap=PARENT_OVERLAP):
+            if len(parent['text']) < MIN_CHUNK_LENGTH * 2:  # 父块至少大点
+                continue
+            subs = [
+                _located(sub['text'], parent['start'] + sub['start'], parent['start'] + sub['end'])
+                for sub in iter_chunks([parent['text']], max_chunk_size=SUB_CHUNK_SIZE, overlap=SUB_OVERLAP)
+                if len(sub['text']) >= MIN_CHUNK_LENGTH
+            ]
+            yield _located(parent['text'], parent['start'], parent['end']), subs
+    print(f"Saved extracted text to {txt_path}")
+
+# 在工作进程中运行：把分块结果逐行写入临时 JSONL 并返回路径，避免整本书的块列表经进程间管道一次性传回
+def _spool_document(data_dir: str, processed_dir: str, doc: str) -> str:
+    fd, spool_path = tempfile.mkstemp(prefix='.chunks_', suffix='.jsonl', dir=processed_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for parent, subs in _iter_document_parents(data_dir, processed_dir, doc):
+            f.write(json.dumps([parent, subs], ensure_ascii=False) + '\n')
+    return spool_path
+
+def _read_spool(spool_path: str) -> Iterator[Tuple[dict, List[dict]]]:
+    try:
+        with open(spool_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parent, subs = json.loads(line)
+                yield parent, subs
+    finally:
+        os.remove(spool_path)
+
+# 多进程并行提取/分块，按文档原顺序流式产出 (doc, chunks)，保证全局编号确定
+def _iter_document_chunks(documents: List[str]) -> Iterator[Tuple[str, Iterator[Tuple[dict, List[dict]]]]]:
+    workers = min(EXTRACT_WORKERS, len(documents))
+    if workers <= 1:
+        for doc in documents:
+            yield doc, _iter_document_parents(DATA_DIR, PROCESSED_DIR, doc)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # 立即把所有文档分发给进程池，结果（临时文件路径）按提交顺序取回
+        futures = [executor.submit(_spool_document, DATA_DIR, PROCESSED_DIR, doc) for doc in documents]
+        yielded = 0
+        try:
+            for doc, fut in zip(documents, futures):
+                yielded += 1
+                yield doc, _read_spool(fut.result())
+        finally:
+            # 中途退出（embedding/写入失败或生成器被关闭）时删除尚未读取的临时文件；已交出的由 _read_spool 删除
+            for fut in futures[yielded:]:
+                if not fut.cancel() and fut.exception() is None:
+                    os.remove(fut.result())
+
+def _chunk_metadata(doc: str, chunk_id: str, chunk: dict) -> dict:
+    return {
+        'source_file': doc,
+        'chunk_id': chunk_id,
+        'page': chunk['page'],
+        'page_end': chunk['page_end'],
+        'char_start': chunk['start'],
+        'char_end': chunk['end'],
+    }
+
+# 把一个文档的块写入块存储，ID 单调递增（FAISS 中的 id = 子块 ID - 1）
+def _append_document(doc: str, chunks: Iterable[Tuple[dict, List[dict]]], store: ChunkStore, new_sub_ids: List[int], new_sub_texts: List[str]) -> None:
+    for parent, subs in chunks:
+        global_parent_id = store.last_id('parents') + 1
+        parent_metadata = _chunk_metadata(doc, f"parent_{global_parent_id:04d}", parent)
+        store.insert_parent(global_parent_id, doc, parent['text'], parent_metadata)
+
+        for sub in subs:
+            global_sub_id = store.last_id('subs') + 1
+            sub_metadata = _chunk_metadata(doc, f"sub_{global_sub_id:04d}", sub)
+            sub_metadata['parent_id'] = global_parent_id  # 链接到父
+            store.insert_sub(global_sub_id, global_parent_id, doc, sub['text'], sub_metadata)
+            new_sub_ids.append(global_sub_id - 1)
+            new_sub_texts.append(sub['text'])
+
+# 全量构建后评估索引并写出报告；compare_types=True 时同时评估所有索引类型
+def _write_index_report(index, embeddings: np.ndarray, ids: np.ndarray, compare_types: bool) -> None:
+    if compare_types:
+        reports = compare_index_types(embeddings, ids, TOP_K)
+    else:
+        reports = [evaluate_index(index, embeddings, ids, TOP_K)]
+    print_index_report(reports)
+    _write_json_atomic(INDEX_REPORT_FILE, {'built_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'reports': reports})
 
-    # Embed chunks using Ollama
-    print("Starting embedding sub-chunks with Ollama...")
-    embeddings = []
-    for i, sub_dict in enumerate(all_sub_chunks):
-        chunk_text = sub_dict['text']
+# 旧版安装的一次性迁移：JSON metadata -> CHUNK_DB_FILE；从旧版单一索引取回向量写入 EMBEDDINGS_FILE，
+# 没有 manifest（基线）时按块存储中的文档补写一份，再用 rebuild_index_from_embeddings 建分片，全程不重新 embedding
+# 向量无法取回或与块存储对不上时什么都不做，由调用方按原逻辑全量构建
+def _migrate_legacy_files() -> None:
+    if not os.path.exists(CHUNK_DB_FILE) and os.path.exists(METADATA_FILE):
+        migrate_json_metadata(METADATA_FILE, CHUNK_DB_FILE)
+    if not os.path.exists(CHUNK_DB_FILE) or not os.path.exists(LEGACY_INDEX_FILE) or os.path.exists(EMBEDDINGS_FILE):
+        return
+    manifest = _load_manifest()
+    # 只接受基线（无 manifest）或版本 2 的单一索引；分块设置变化时向量已不对应
+    if manifest is not None and not (manifest.get('settings', {}).get('manifest_version') == 2 and _only_index_changed(manifest)):
+        return
+
+    print(f"Recovering vectors from {LEGACY_INDEX_FILE} ...")
+    store = ChunkStore(CHUNK_DB_FILE)
+    positions = np.array(store.sub_positions(), dtype=np.int64)
+    parent_counts = store.parent_counts()
+    rows = store.last_id('subs')
+    store.close()
+    try:
+        vectors, ids = reconstruct_vectors(faiss.read_index(LEGACY_INDEX_FILE))
+    except RuntimeError as e:
+        print(f"Cannot read vectors from {LEGACY_INDEX_FILE} ({e}).")
+        return
+    if not np.array_equal(np.sort(ids), positions):
+        print(f"{LEGACY_INDEX_FILE} does not match {CHUNK_DB_FILE}.")
+        return
+    save_embedding_sidecar(EMBEDDINGS_FILE, vectors, ids, rows)
+    del vectors
+
+    if manifest is None:
+        # 基线没有记录文档 hash：按当前文件记录（与基线一样假定索引建好后文档未变）；数据目录中已不存在的文档留空，下次增量更新时删除
+        present = set(_list_documents(DATA_DIR)) if os.path.exists(DATA_DIR) else set()
+        states = _document_states(DATA_DIR, sorted(d for d in parent_counts if d in present), {})
+        missing = {'sha256': None, 'size': None, 'mtime': None}
+        manifest = {
+            'settings': dict(_index_settings(), manifest_version=2, index_type='flat'),
+            'index_version': uuid.uuid4().hex,
+            'built_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'documents': {doc: dict(states.get(doc, missing), parents=count) for doc, count in parent_counts.items()},
+        }
+        _write_json_atomic(MANIFEST_FILE, manifest)
+    rebuild_index_from_embeddings()
+
+# Function to build index
+# incremental=True 时只处理新增/变化的文档，删除文档的向量按 ID 从索引中移除
+# compare_types=True 时在全量构建后对所有索引类型做召回率/延迟对比
+# 整个构建记录为一个 'build_index' span，各阶段（scan_documents / extract_embed / add_vectors / save / index_report）为其子 span
+def build_index(incremental: bool = False, compare_types: bool = False) -> tuple:
+    with span('build_index', incremental=incremental, index_type=INDEX_TYPE) as root:
+        return _build_index(incremental, compare_types, root)
+
+def _build_index(incremental: bool, compare_types: bool, root) -> tuple:
+    if not os.path.exists(PROCESSED_DIR):
+        os.makedirs(PROCESSED_DIR)  # 创建目录如果不存在
+
+    documents = _list_documents(DATA_DIR)
+    if not documents:
+        raise ValueError(f"No PDF or EPUB documents found in '{DATA_DIR}' folder.")
+
+    if incremental:
+        _migrate_legacy_files()
+    manifest = _load_manifest() if incremental else None
+    if manifest is not None and _only_index_changed(manifest) and os.path.exists(CHUNK_DB_FILE):
         try:
-            emb_response = ollama.embeddings(model=EMBEDDING_MODEL, prompt=chunk_text)
-            embeddings.append(emb_response['embedding'])
-            if (i + 1) % 100 == 0:
-                print(f"Embedded {i + 1}/{len(all_sub_chunks)} chunks")
-        except Exception as e:
-            raise ValueError(f"Ollama embedding error for chunk {i}: {e}.")
-    
-    embeddings = np.array(embeddings, dtype=np.float32)
-    dim = embeddings.shape[1]
-    
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
-
-   # 保存：分开存 parent 和 sub
-    metadata = {'parents': all_parent_chunks, 'subs': all_sub_chunks}
-    faiss.write_index(index, INDEX_FILE)
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False)
-    
-    print(f"Index built... Total parents: {len(all_parent_chunks)}, subs: {len(all_sub_chunks)}")
-    return index, metadata  # 返回 dict
+            rebuild_index_from_embeddings(compare_types=compare_types)
+            manifest = _load_manifest()
+        except ValueError as e:
+            print(f"{e} Doing a full rebuild...")
+    can_update = (
+        manifest is not None
+        and manifest.get('settings') == _index_settings()
+        and os.path.exists(CHUNK_DB_FILE)
+    )
+    if incremental and not can_update:
+        print("No compatible manifest found (or settings changed), doing a full rebuild...")
+    if can_update and _missing_shards(manifest):
+        # 缺失的分片优先从 EMBEDDINGS_FILE 单独重建；不行时下面重新处理这些文档
+        try:
+            rebuild_index_from_embeddings(sorted(_missing_shards(manifest)))
+            manifest = _load_manifest()
+        except ValueError as e:
+            print(f"{e} Re-processing documents with missing shards...")
+
+    with span('scan_documents', documents=len(documents)):
+        states = _document_states(DATA_DIR, documents, manifest['documents'] if manifest else {})
+
+    # 分片文件仍缺失的文档按变化处理，只重新处理这些文档
+    known_docs = manifest['documents'] if can_update else {}
+    missing = _missing_shards(manifest) if can_update else set()
+    changed = [d for d in documents if known_docs.get(d, {}).get('sha256') != states[d]['sha256'] or d in missing]
+    stale = set(d for d in known_docs if d not in states) | set(d for d in changed if d in known_docs)
+    if can_update and not changed and not stale:
+        if any(states[d] != {k: known_docs[d][k] for k in states[d]} for d in documents):
+            # 仅 mtime 变化（如文件被 touch）：刷新 manifest，下次加载无需重新计算 hash
+            for d in documents:
+                manifest['documents'][d].update(states[d])
+            _write_json_atomic(MANIFEST_FILE, manifest)
+        print("Index is up to date, nothing to do.")
+        index, parents, subs = read_index()
+        return index, {'parents': parents, 'subs': subs}
+
+    if can_update:
+        # 增量：在原有块存储上原地增删；写操作缓存到 embedding 完成后，在一个短事务里写入，期间读取方看到的仍是旧数据
+        # 未变化文档的分片不动
+        store = ChunkStore(CHUNK_DB_FILE, readonly=False, buffered=True)
+        db_tmp_path = None
+    else:
+        # 全量：写入临时库，完成后原子替换，已打开旧库的进程不受影响
+        db_tmp_path = CHUNK_DB_FILE + '.tmp'
+        if os.path.exists(db_tmp_path):
+            os.remove(db_tmp_path)
+        store = ChunkStore(db_tmp_path, readonly=False)
+
+    # 移除已删除/已变化文档的块（其余块的 ID 保持不变）；它们的分片在保存时被替换或删除
+    if stale:
+        removed_ids = store.sub_positions_for_sources(stale)
+        store.delete_sources(stale)
+        print(f"Removed {len(removed_ids)} sub-chunks from {len(stale)} deleted/changed documents.")
+
+    new_sub_ids = []
+    doc_ranges = {}  # 文档 -> 其子块在 new_sub_ids 中的 [start, end)
+
+    # 边取回分块结果边产出子块文本：embedding 线程在等待 Ollama 时，进程池继续解析后面的文档
+    def iter_new_sub_texts() -> Iterator[str]:
+        for doc, chunks in _iter_document_chunks(changed):
+            texts = []
+            start = len(new_sub_ids)
+            _append_document(doc, chunks, store, new_sub_ids, texts)
+            doc_ranges[doc] = (start, len(new_sub_ids))
+            yield from texts
+
+    # Embed chunks using Ollama（批量 + 并发 + 断点续传）
+    print(f"Processing {len(changed)} documents with {min(EXTRACT_WORKERS, len(changed))} workers, embedding sub-chunks with Ollama...")
+    with span('extract_embed', documents=len(changed), workers=min(EXTRACT_WORKERS, len(changed))) as s:
+        embeddings = embed_texts(iter_new_sub_texts(), model=EMBEDDING_MODEL)
+        s.set(chunks=len(new_sub_ids))
+
+    full_build = not can_update
+    if full_build and not new_sub_ids:
+        raise ValueError("No sub-chunks extracted.")
+
+    # 每个新增/变化的文档单独建一个分片
+    new_ids = np.array(new_sub_ids, dtype=np.int64)
+    shards = {}
+    with span('add_vectors', vectors=len(new_sub_ids), full_build=full_build) as s:
+        for doc, (start, end) in doc_ranges.items():
+            if end > start:
+                shards[doc] = _build_shard(embeddings[start:end], new_ids[start:end])
+        s.set(shards=len(shards))
+
+    def shard_of(doc: str):
+        if doc in shards or (doc not in doc_ranges and known_docs.get(doc, {}).get('shard')):
+            return _shard_file(doc)
+        return None  # 没有子块的文档
+
+    # 保存：先提交块存储，再写原始向量与分片，最后写 manifest 并删除不再引用的分片
+    with span('save'):
+        store.commit()
+        parent_counts = store.parent_counts()
+        sub_rows = store.last_id('subs')
+        store.close()
+        if db_tmp_path:
+            os.replace(db_tmp_path, CHUNK_DB_FILE)
+        if new_sub_ids and not save_embedding_sidecar(EMBEDDINGS_FILE, embeddings, new_ids, sub_rows, update=not full_build):
+            print(f"No {EMBEDDINGS_FILE} from an earlier build; run a full build_index() to create it.")
+        manifest = {
+            'settings': _index_settings(),
+            'index_version': uuid.uuid4().hex,
+            'built_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'documents': {doc: dict(states[doc], parents=parent_counts[doc], shard=shard_of(doc)) for doc in documents},
+        }
+        os.makedirs(SHARD_DIR, exist_ok=True)
+        for doc, shard in shards.items():
+            _write_index_atomic(shard, _shard_path(doc))
+        _write_json_atomic(MANIFEST_FILE, manifest)
+        _remove_unused_shards(manifest)
+        clear_checkpoints()  # 索引已落盘，断点文件不再需要
+    index = ShardedIndex(shards) if full_build else read_index()[0]
+    if full_build:
+        with span('index_report', compare_types=compare_types):
+            _write_index_report(index, embeddings, new_ids, compare_types)
+    root.set(documents=len(changed), parents=sum(parent_counts.values()), subs=index.ntotal)
+
+    print(f"Index built... Total parents: {sum(parent_counts.values())}, subs: {index.ntotal} (processed {len(changed)} documents)")
+    store = ChunkStore(CHUNK_DB_FILE)
+    return index, {'parents': store.parents, 'subs': store.subs}  # 返回 dict（惰性读取的父块/子块视图）
+
+# Function to check whether the on-disk index is out of date with the data directory
+def index_is_stale() -> bool:
+    manifest = _load_manifest()
+    if manifest is None:
+        return True
+    if manifest.get('settings') != _index_settings() or _missing_shards(manifest):
+        return True
+    try:
+        documents = _list_documents(DATA_DIR)
+    except ValueError:
+        return False  # 数据目录不存在时沿用已有索引
+    known = manifest['documents']
+    if set(documents) != set(known):
+        return True
+    states = _document_states(DATA_DIR, documents, known)
+    return any(states[d]['sha256'] != known[d]['sha256'] for d in documents)
 
 # Function to load existing index
 def load_index() -> tuple:
-    if not os.path.exists(INDEX_FILE) or not os.path.exists(METADATA_FILE):
+    with span('load_index'):
+        return _load_index()
+
+def _load_index() -> tuple:
+    _migrate_legacy_files()  # 一次性迁移旧版的 JSON metadata 与单一索引
+    if _load_manifest() is None or not os.path.exists(CHUNK_DB_FILE):
         print("Index not found, building new one...")
-        return build_index()
-    index = faiss.read_index(INDEX_FILE)
-    with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
+        index, metadata = build_index()
+    elif index_is_stale():
+        print("Documents changed, updating index incrementally...")
+        index, metadata = build_index(incremental=True)
+    else:
+        index, parents, subs = read_index()
+        print("Index loaded: parents and subs")
+        return index, parents, subs
     parents = metadata['parents']
     subs = metadata['subs']
-    print("Index loaded: parents and subs")
     return index, parents, subs  # 返回 index, parents, subs
 
+# Function to read the on-disk index without building or updating it
+# 返回 ShardedIndex（manifest 中每个文档一个分片）；parents/subs 为按需从块存储读取的视图，启动耗时与内存不随语料规模增长
+def read_index() -> tuple:
+    with span('read_index') as s:
+        manifest = _load_manifest()
+        if manifest is None:
+            raise ValueError(f"{MANIFEST_FILE} not found; run build_index() first.")
+        # 只读内存映射（INDEX_MMAP），并设置查询时参数（nprobe / efSearch）
+        index = ShardedIndex({doc: read_index_file(os.path.join(SHARD_DIR, info['shard']))
+                              for doc, info in manifest['documents'].items() if info.get('shard')})
+        store = ChunkStore(CHUNK_DB_FILE)
+        s.set(vectors=index.ntotal, shards=len(index.shards))
+        return index, store.parents, store.subs
+
+# Function to rebuild index shards of type INDEX_TYPE from EMBEDDINGS_FILE (no extraction or re-embedding)
+# sources 为空时重建全部分片（切换 INDEX_TYPE 或从单一索引迁移），否则只重建指定文档的分片
+# 向量从 float16 内存映射读取；完成后原子替换分片并在 manifest 中记录新的索引设置与 index_version
+def rebuild_index_from_embeddings(sources: List[str] = None, compare_types: bool = False) -> ShardedIndex:
+    with span('rebuild_index', index_type=INDEX_TYPE, sources=len(sources) if sources else None) as s:
+        manifest = _load_manifest()
+        sidecar = load_embedding_sidecar(EMBEDDINGS_FILE)
+        if manifest is None or sidecar is None or not os.path.exists(CHUNK_DB_FILE):
+            raise ValueError(f"{EMBEDDINGS_FILE} or {MANIFEST_FILE} not found; cannot rebuild without re-embedding.")
+        unknown = set(sources or ()) - set(manifest['documents'])
+        if unknown:
+            raise ValueError(f"Unknown documents: {', '.join(sorted(unknown))}")
+        if sources and manifest.get('settings') != _index_settings():
+            raise ValueError("Index settings changed; rebuild all shards instead of selected documents.")
+
+        # 先确认 sidecar 覆盖全部子块，再开始写分片
+        store = ChunkStore(CHUNK_DB_FILE)
+        targets = {doc: np.sort(np.array(store.sub_positions_for_sources([doc]), dtype=np.int64))
+                   for doc in (sources or manifest['documents'])}
+        all_ids = np.array(store.sub_positions(), dtype=np.int64) if not sources else None
+        store.close()
+        if any(len(ids) and ids[-1] >= sidecar.shape[0] for ids in targets.values()):
+            raise ValueError(f"{EMBEDDINGS_FILE} does not cover every sub-chunk; cannot rebuild without re-embedding.")
+
+        print(f"Rebuilding {len(targets)} '{INDEX_TYPE}' shards from stored embeddings...")
+        os.makedirs(SHARD_DIR, exist_ok=True)
+        for doc, ids in targets.items():
+            if len(ids):
+                _write_index_atomic(_build_shard(sidecar[ids], ids), _shard_path(doc))  # sidecar[ids] 为 float16 副本
+            manifest['documents'][doc]['shard'] = _shard_file(doc) if len(ids) else None
+        manifest['settings'] = _index_settings()
+        manifest['index_version'] = uuid.uuid4().hex
+        manifest['built_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        _write_json_atomic(MANIFEST_FILE, manifest)
+        _remove_unused_shards(manifest)
+        index = read_index()[0]
+        if all_ids is not None and len(all_ids):
+            _write_index_report(index, np.asarray(sidecar[all_ids], dtype=np.float32), all_ids, compare_types)
+        s.set(vectors=int(index.ntotal))
+        return index
+
+# 当前索引版本（每次构建生成新的 index_version）；旧索引没有 manifest 时返回 None
+def current_index_version():
+    manifest = _load_manifest()
+    return manifest.get('index_version') if manifest else None
+
 # 如果单独运行这个文件，就构建索引（测试用）
 if __name__ == "__main__":
-    build_index()  # 或 load_index()，根据需要
\ No newline at end of file
+    import sys
+    if '--rebuild' in sys.argv:
+        # 从 EMBEDDINGS_FILE 重建，不重新 embedding；--rebuild 后可跟文档名，只重建这些文档的分片
+        books = [arg for arg in sys.argv[sys.argv.index('--rebuild') + 1:] if not arg.startswith('--')]
+        rebuild_index_from_embeddings(books or None, compare_types='--compare' in sys.argv)
+    else:
+        build_index(incremental='--incremental' in sys.argv, compare_types='--compare' in sys.argv)  # 或 load_index()，根据需要
@@ -1,8 +1,15 @@
 # main.py: 哈耶克研究委员会主应用入口
-from query_handler import handle_query  # 导入查询处理函数
+from service_client import SERVICE_URL, ServiceClient  # 设置 HAYEK_SERVICE_URL 时作为检索服务的瘦客户端
 
 def main():
     print("欢迎使用哈耶克研究委员会！")
+    if SERVICE_URL:
+        handle_query_stream = ServiceClient(SERVICE_URL).handle_query_stream
+        print(f"使用检索服务：{SERVICE_URL}")
+    else:
+        from query_handler import handle_query_stream  # 导入流式查询处理函数
+        from index_cache import get_index  # 进程内常驻索引
+        get_index()  # 启动时预加载索引，之后的提问直接复用
     print("请输入中文问题（例如：'哈耶克如何看待中央计划经济？'），输入 'quit' 退出。")
     
     while True:
@@ -17,10 +24,16 @@ def main():
         
         try:
             print("委员会正在分析中...（这可能需要几秒钟）")
-            report = handle_query(question)
+            # 流式输出：报告逐段打印，无需等待全部生成
+            for event, payload in handle_query_stream(question):
+                if event == 'refine' and payload['keywords']:
+                    print(f"提取关键词：{', '.join(payload['keywords'])}")
+                elif event == 'sources':
+                    print(f"已召回 {len(payload)} 个来源，正在生成报告...")
+                    print("\n" + "="*50)
+                elif event == 'token':
+                    print(payload, end='', flush=True)
             print("\n" + "="*50)
-            print(report)
-            print("="*50)
         except Exception as e:
             print(f"处理出错：{e}。请检查 Ollama 是否运行、API key 是否有效，或索引是否构建。")
 
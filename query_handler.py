@@ -1,18 +1,37 @@
 # query_handler.py: 处理查询精炼、检索和报告生成
-import ollama
-import faiss
+import time
 import numpy as np
-from typing import List, Tuple
-from utils import call_deepseek_api  # 导入 API 调用
-from indexing import load_index, EMBEDDING_MODEL  # 导入索引加载和模型名
+from typing import Callable, Iterator, List, Optional, Tuple
+from utils import call_deepseek_api, MODEL_NAME, TEMPERATURE  # 导入 API 调用与模型参数（用于缓存键）
+from indexing import EMBEDDING_MODEL, TOP_K  # 导入模型名与检索条数
+from embedding import embed_texts  # 批量 embedding（带重试）
+from context_packing import pack_context, estimate_tokens, CONTEXT_TOKEN_BUDGET  # 报告上下文打包
+from chunk_store import ChunkTable  # 父块/子块的惰性视图
+from vector_index import ShardedIndex  # 按文档分片的索引
+from index_cache import get_index  # 进程内常驻索引，避免每次查询重新读盘
+from cache import get_cache, make_key, normalize_question  # 精炼/embedding/报告缓存
+from tracing import span  # 分阶段计时
 
-TOP_K = 5  # 检索 top-5 chunks
+# Prompts（同时作为缓存键的一部分，修改后旧缓存自动失效）
+REFINE_SYSTEM_PROMPT = "You are a query analyzer for Hayek's works. First, analyze if the question is suitable (related to economics, philosophy, spontaneous order, etc.). If too narrow/irrelevant, suggest expansion. Then, refine to English query and 3-5 keywords."
+REFINE_PROMPT = "Given the Chinese question: '{question}'\n\nStep 1: Analyze suitability (1-2 sentences): Is it relevant to Hayek? If not, suggest related topic. If shallow, suggest deeper angle.\nStep 2: Refined Query: [concise english query, or empty if unsuitable]\nStep 3: Keywords: [kw1, kw2, ...] (3-5 English keywords, or empty if unsuitable)\nOutput exactly in this format."
+REPORT_SYSTEM_PROMPT = "You are the Hayek Research Committee AI. Generate a structured Chinese report based on Hayek's views from the provided context. Be neutral, inspirational, emphasize spontaneous order, dispersed knowledge, price signals. End with implications. Include disclaimer. If analysis is provided, incorporate its insights to deepen the response."
+REPORT_PROMPT = "Original Question: {question}\n\nAnalysis (if any): {analysis}\n\nRetrieved Context:\n{context}\n\nGenerate report in Chinese:\n- Section 1: '用户提问' (repeat question)\n- Section 2: '委员会意见' (200-400 words summary, quotes/paraphrases, analysis, implications; reference the above analysis to make it more targeted)\nDisclaimer at end: 'This is AI-generated inspiration based on Hayek's works, not authoritative interpretation.'"
 
 # Function to refine query
 def refine_query(chinese_question: str) -> Tuple[str, List[str], str]:
-    system_prompt = "You are a query analyzer for Hayek's works. First, analyze if the question is suitable (related to economics, philosophy, spontaneous order, etc.). If too narrow/irrelevant, suggest expansion. Then, refine to English query and 3-5 keywords."
-    prompt = f"Given the Chinese question: '{chinese_question}'\n\nStep 1: Analyze suitability (1-2 sentences): Is it relevant to Hayek? If not, suggest related topic. If shallow, suggest deeper angle.\nStep 2: Refined Query: [concise english query, or empty if unsuitable]\nStep 3: Keywords: [kw1, kw2, ...] (3-5 English keywords, or empty if unsuitable)\nOutput exactly in this format."
-    response = call_deepseek_api(prompt, system_prompt)
+    with span('refine_query') as s:
+        return _refine_query(chinese_question, s)
+
+def _refine_query(chinese_question: str, s) -> Tuple[str, List[str], str]:
+    prompt = REFINE_PROMPT.format(question=normalize_question(chinese_question))
+    cache_key = make_key('refine', MODEL_NAME, TEMPERATURE, REFINE_SYSTEM_PROMPT, prompt)
+    cached = get_cache().get('refine', cache_key)
+    s.set(cached=cached is not None)
+    if cached is not None:
+        english_query, keywords, analysis = cached
+        return english_query, keywords, analysis
+    response = call_deepseek_api(prompt, REFINE_SYSTEM_PROMPT)
     
     # Parse response
     try:
@@ -24,61 +43,218 @@ def refine_query(chinese_question: str) -> Tuple[str, List[str], str]:
         english_query = query_line.split(':', 1)[1].strip() if ':' in query_line else ''
         keywords_str = keywords_line.split(':', 1)[1].strip() if ':' in keywords_line else ''
         keywords = [kw.strip() for kw in keywords_str.split(',')] if keywords_str else []
-        
-        return english_query, keywords, analysis  # 返回 analysis
     except IndexError:
         raise ValueError("Invalid response format from query refinement.")
+    get_cache().set('refine', cache_key, [english_query, keywords, analysis])
+    return english_query, keywords, analysis  # 返回 analysis
+
+# 查询向量的缓存键：embed_query 与 embed_queries 共用；键中包含 Ollama 接口名，
+# 旧版经 /api/embeddings（未归一化）写入的条目不会被复用
+EMBED_ENDPOINT = 'api/embed'
+
+def _embedding_cache_key(english_query: str) -> str:
+    return make_key('embedding', EMBEDDING_MODEL, EMBED_ENDPOINT, english_query)
+
+# Function to embed a query (cached per embedding model)
+# 与建索引走同一个 embed_texts / ollama.embed 路径（/api/embed 返回归一化向量），查询与索引向量的尺度一致
+def embed_query(english_query: str) -> List[float]:
+    with span('embed_query', model=EMBEDDING_MODEL, query_chars=len(english_query)) as s:
+        cache_key = _embedding_cache_key(english_query)
+        cached = get_cache().get('embedding', cache_key)
+        s.set(cached=cached is not None)
+        if cached is not None:
+            return cached
+        # Embed query using Ollama
+        try:
+            embedding = embed_texts([english_query], model=EMBEDDING_MODEL, batch_size=1, concurrency=1,
+                                    checkpoint_dir=None, progress=False)[0].tolist()
+        except ValueError as e:
+            raise ValueError(f"{e} Ensure 'ollama serve' is running.")
+        get_cache().set('embedding', cache_key, embedding)
+        return embedding
+
+# Function to embed many queries: 命中缓存的直接复用，其余在一个 batch 中请求 Ollama
+def embed_queries(english_queries: List[str]) -> np.ndarray:
+    with span('embed_query', model=EMBEDDING_MODEL, queries=len(english_queries)) as s:
+        cache_keys = [_embedding_cache_key(q) for q in english_queries]
+        vectors = [get_cache().get('embedding', key) for key in cache_keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        s.set(cached=len(english_queries) - len(missing))
+        if missing:
+            embeddings = embed_texts([english_queries[i] for i in missing], model=EMBEDDING_MODEL,
+                                     batch_size=len(missing), concurrency=1, checkpoint_dir=None, progress=False)
+            for i, row in zip(missing, embeddings):
+                vectors[i] = row.tolist()
+                get_cache().set('embedding', cache_keys[i], vectors[i])
+        return np.array(vectors, dtype=np.float32)
 
 # Function to retrieve chunks
-def retrieve_chunks(english_query: str, index: faiss.IndexFlatL2, parents: List[dict], subs: List[dict]) -> List[dict]:
-    # Embed query using Ollama
-    try:
-        query_emb_response = ollama.embeddings(model=EMBEDDING_MODEL, prompt=english_query)
-        query_emb = np.array([query_emb_response['embedding']], dtype=np.float32)
-    except Exception as e:
-        raise ValueError(f"Ollama embedding error for query: {e}. Ensure 'ollama serve' is running.")
-
-    # Search FAISS index
-    distances, indices = index.search(query_emb, TOP_K)
-    sub_indices = [i for i in indices[0] if i < len(subs)]
-    
-    # 收集唯一 parent_ids
-    parent_ids = set(subs[i]['metadata']['parent_id'] for i in sub_indices)
-    retrieved = [parents[pid - 1] for pid in parent_ids if pid - 1 < len(parents)]  # ID 从1开始，list 从0
+# embed 可替换为其他 embedding 方式（如 retrieval_service.py 中跨请求合批的 embedding）
+# sources 为文档名列表时只搜索这些书的分片（为空则搜索全部），耗时随所选书的规模而不是整个语料增长
+def retrieve_chunks(english_query: str, index: ShardedIndex, parents: ChunkTable, subs: ChunkTable,
+                    embed: Callable[[str], List[float]] = embed_query, sources: Optional[List[str]] = None) -> List[dict]:
+    query_emb = np.array([embed(english_query)], dtype=np.float32)
+
+    # Search FAISS index（所选分片并行搜索后合并 top-k）
+    with span('faiss_search', k=TOP_K, ntotal=index.ntotal, books=len(sources) if sources else None):
+        distances, indices = index.search(query_emb, TOP_K, sources=sources)
+    return _parents_for_hits(indices[0], parents, subs)
+
+# Function to retrieve chunks for many queries at once
+# 一次 embedding 请求 + 一次多向量 FAISS 搜索，返回与输入顺序一致的父块列表
+def retrieve_chunks_batch(english_queries: List[str], index: ShardedIndex, parents: ChunkTable, subs: ChunkTable,
+                          sources: Optional[List[str]] = None) -> List[List[dict]]:
+    if not english_queries:
+        return []
+    query_embs = embed_queries(english_queries)
+    with span('faiss_search', k=TOP_K, ntotal=index.ntotal, queries=len(english_queries), books=len(sources) if sources else None):
+        distances, indices = index.search(query_embs, TOP_K, sources=sources)
+    return [_parents_for_hits(row, parents, subs) for row in indices]
+
+# 把一条查询的 FAISS 结果映射回父块
+def _parents_for_hits(hits, parents: ChunkTable, subs: ChunkTable) -> List[dict]:
+    # FAISS id 即子块位置（ID - 1）；-1 表示结果不足，None 表示该块所属文档已被增量删除
+    with span('fetch_chunks') as fetch:
+        sub_indices = [int(i) for i in hits if 0 <= i < len(subs)]
+        sub_chunks = [s for s in subs.get_many(sub_indices) if s]  # 只从块存储读取命中的子块
+
+        # 收集唯一 parent_ids，按子块的检索排名排列（排名靠前的证据在前）
+        parent_ids = dict.fromkeys(s['metadata']['parent_id'] for s in sub_chunks)
+        retrieved = [p for p in parents.get_many(pid - 1 for pid in parent_ids) if p]  # ID 从1开始，位置从0
+        fetch.set(subs=len(sub_chunks), parents=len(retrieved))
     
-    print(f"Retrieved {len(retrieved)} parent chunks from {len(sub_indices)} subs.")
+    print(f"Retrieved {len(retrieved)} parent chunks from {len(sub_chunks)} subs.")
     return retrieved
 
+# 构造报告 prompt 与缓存键（prompt 已包含问题、分析与检索上下文，相同输入直接复用报告）
+# 检索上下文经 pack_context 合并、去重并限制在 token 预算内；另返回打包前后的估算 token 数（记入 span）
+def _report_prompt(chinese_question: str, retrieved_chunks: List[dict], analysis: str) -> Tuple[str, str, dict]:
+    passages = pack_context(retrieved_chunks)
+    context = '\n\n'.join(passages)
+    prompt = REPORT_PROMPT.format(question=chinese_question, analysis=analysis, context=context)
+    stats = {
+        'context_chunks': len(retrieved_chunks),
+        'context_passages': len(passages),
+        'raw_context_tokens': sum(estimate_tokens(chunk['text']) for chunk in retrieved_chunks),
+        'context_tokens': estimate_tokens(context),
+    }
+    return prompt, make_key('report', MODEL_NAME, TEMPERATURE, REPORT_SYSTEM_PROMPT, prompt), stats
+
 # Function to generate report
 def generate_report(chinese_question: str, retrieved_chunks: List[dict], analysis: str = "") -> str:
-    context = '\n\n'.join([chunk['text'] for chunk in retrieved_chunks])
-    system_prompt = "You are the Hayek Research Committee AI. Generate a structured Chinese report based on Hayek's views from the provided context. Be neutral, inspirational, emphasize spontaneous order, dispersed knowledge, price signals. End with implications. Include disclaimer. If analysis is provided, incorporate its insights to deepen the response."
-    prompt = f"Original Question: {chinese_question}\n\nAnalysis (if any): {analysis}\n\nRetrieved Context:\n{context}\n\nGenerate report in Chinese:\n- Section 1: '用户提问' (repeat question)\n- Section 2: '委员会意见' (200-400 words summary, quotes/paraphrases, analysis, implications; reference the above analysis to make it more targeted)\nDisclaimer at end: 'This is AI-generated inspiration based on Hayek's works, not authoritative interpretation.'"
-    return call_deepseek_api(prompt, system_prompt)
-
-# 主工作流函数（可供 main.py 调用）
-def handle_query(chinese_question: str) -> Tuple[str, List[dict]]:
-    index, parents, subs = load_index()  # 解包 parents, subs
+    with span('generate_report', stream=False) as s:
+        prompt, cache_key, stats = _report_prompt(chinese_question, retrieved_chunks, analysis)
+        cached = get_cache().get('report', cache_key)
+        s.set(cached=cached is not None, **stats)
+        if cached is not None:
+            return cached
+        report = call_deepseek_api(prompt, REPORT_SYSTEM_PROMPT)
+        get_cache().set('report', cache_key, report)
+        return report
+
+# Function to generate report as a stream of text pieces（命中缓存时一次性产出整份报告）
+def generate_report_stream(chinese_question: str, retrieved_chunks: List[dict], analysis: str = "") -> Iterator[str]:
+    with span('generate_report', stream=True) as s:
+        prompt, cache_key, stats = _report_prompt(chinese_question, retrieved_chunks, analysis)
+        cached = get_cache().get('report', cache_key)
+        s.set(cached=cached is not None, **stats)
+        if cached is not None:
+            yield cached
+            return
+        pieces = []
+        for delta in call_deepseek_api(prompt, REPORT_SYSTEM_PROMPT, stream=True):
+            if not pieces:
+                s.set(ttft_ms=s.elapsed() * 1000)
+            pieces.append(delta)
+            yield delta
+        get_cache().set('report', cache_key, ''.join(pieces).strip())
+
+# 问题不适合 Hayek 语料时的建议报告（不检索、不调用报告生成）
+def unsuitable_report(chinese_question: str, analysis: str) -> str:
+    return f"用户提问：{chinese_question}\n\n委员会意见：{analysis} 建议您调整问题以更好地匹配 Hayek 的观点，例如探讨自发秩序或知识分散。\n\nThis is AI-generated inspiration based on Hayek's works, not authoritative interpretation."
+
+# 报告开头注入的分析建议
+def analysis_prefix(analysis: str) -> str:
+    return f"分析建议：{analysis}\n\n" if analysis else ''
+
+# 整份结果缓存键：问题 + 索引版本 + 限定的书目 + 影响结果的全部模型与 prompt
+def answer_cache_key(chinese_question: str, index_version, sources: Optional[List[str]] = None) -> str:
+    return make_key('answer', normalize_question(chinese_question), index_version or 'unversioned',
+                    sorted(set(sources)) if sources else None,
+                    MODEL_NAME, TEMPERATURE, EMBEDDING_MODEL, TOP_K, CONTEXT_TOKEN_BUDGET,
+                    REFINE_SYSTEM_PROMPT, REFINE_PROMPT, REPORT_SYSTEM_PROMPT, REPORT_PROMPT)
+
+# 流式工作流：依次产出 (事件, 数据)
+#   ('refine', {'english_query', 'keywords', 'analysis'}) -> ('sources', 父块列表) -> ('token', 文本片段)... -> ('done', {'report', 'chunks', 'keywords'})
+# 整个查询记录为一个 'query' span，各阶段（get_index / refine_query / embed_query / faiss_search / fetch_chunks / generate_report / llm）为其子 span
+# sources 限定检索的书目（文档名列表），为空时检索全部
+def handle_query_stream(chinese_question: str, embed: Callable[[str], List[float]] = embed_query,
+                        sources: Optional[List[str]] = None) -> Iterator[Tuple[str, object]]:
+    with span('query', question=normalize_question(chinese_question), books=len(sources) if sources else None) as root:
+        yield from _handle_query_stream(chinese_question, root, embed, sources)
+
+def _handle_query_stream(chinese_question: str, root, embed: Callable[[str], List[float]],
+                         sources: Optional[List[str]]) -> Iterator[Tuple[str, object]]:
+    start = time.perf_counter()
+    with span('get_index'):
+        index, parents, subs, index_version = get_index()  # 常驻快照：解包 index, parents, subs（本次查询全程使用同一版本）
+    # 整份结果的缓存：键包含索引版本，重建索引后自动失效
+    cache_key = answer_cache_key(chinese_question, index_version, sources)
+    cached = get_cache().get('answer', cache_key)
+    root.set(cached=cached is not None, index_version=index_version)
+    if cached is not None:
+        print("Answer served from cache.")
+        report, retrieved_parents, keywords = cached
+        yield 'refine', {'english_query': '', 'keywords': keywords, 'analysis': ''}
+        yield 'sources', retrieved_parents
+        yield 'token', report
+        yield 'done', {'report': report, 'chunks': retrieved_parents, 'keywords': keywords}
+        return
+
     english_query, keywords, analysis = refine_query(chinese_question)  # 解包 analysis
-    
     print(f"Analysis: {analysis}\nRefined Query: {english_query}\nKeywords: {keywords}")
+    yield 'refine', {'english_query': english_query, 'keywords': keywords, 'analysis': analysis}
     
     if not english_query:  # 如果不适合，生成建议报告
-        report = f"用户提问：{chinese_question}\n\n委员会意见：{analysis} 建议您调整问题以更好地匹配 Hayek 的观点，例如探讨自发秩序或知识分散。\n\nThis is AI-generated inspiration based on Hayek's works, not authoritative interpretation."
-        return report, []  # 无 chunks
+        report = unsuitable_report(chinese_question, analysis)
+        get_cache().set('answer', cache_key, [report, [], keywords])
+        yield 'sources', []  # 无 chunks
+        yield 'token', report
+        yield 'done', {'report': report, 'chunks': [], 'keywords': keywords}
+        return
     
-    retrieved_parents = retrieve_chunks(english_query, index, parents, subs)  # 传 parents, subs，返回 parents
-    
-    report = generate_report(chinese_question, retrieved_parents, analysis)  # 用 parents
+    retrieved_parents = retrieve_chunks(english_query, index, parents, subs, embed, sources)  # 传 parents, subs，返回 parents
+    root.set(sources=len(retrieved_parents))
+    yield 'sources', retrieved_parents
     
     # 如果有分析建议，注入报告开头
-    if analysis:
-        report = f"分析建议：{analysis}\n\n" + report
+    prefix = analysis_prefix(analysis)
+    if prefix:
+        yield 'token', prefix
+    pieces = []
+    llm_start = time.perf_counter()
+    for delta in generate_report_stream(chinese_question, retrieved_parents, analysis):  # 用 parents
+        if not pieces:
+            now = time.perf_counter()
+            root.set(ttft_ms=(now - start) * 1000)
+            print(f"Time to first token: {now - start:.2f}s since question (LLM {now - llm_start:.2f}s)")
+        pieces.append(delta)
+        yield 'token', delta
+    report = prefix + ''.join(pieces).strip()
+    root.set(report_chars=len(report))
     
-    return report, retrieved_parents, keywords  # 返回父块
+    get_cache().set('answer', cache_key, [report, retrieved_parents, keywords])
+    yield 'done', {'report': report, 'chunks': retrieved_parents, 'keywords': keywords}  # 返回父块
+
+# 主工作流函数（可供 main.py 调用）：消费流式工作流，返回完整结果
+def handle_query(chinese_question: str, sources: Optional[List[str]] = None) -> Tuple[str, List[dict], List[str]]:
+    for event, payload in handle_query_stream(chinese_question, sources=sources):
+        if event == 'done':
+            return payload['report'], payload['chunks'], payload['keywords']
+    raise ValueError("Query pipeline ended without a report.")
 
 # 如果单独运行这个文件，就测试一个查询
 if __name__ == "__main__":
     sample_question = "哈耶克如何看待中央计划经济？"
     report = handle_query(sample_question)
-    print(report)
\ No newline at end of file
+    print(report)
@@ -0,0 +1,263 @@
+# retrieval_service.py: 本机检索/报告服务（asyncio）。一个进程持有唯一的索引与 HTTP 客户端，app.py / main.py 通过 service_client.py 作为瘦客户端调用
+# 相同的并发请求合并为一次执行（结果分发给全部等待方）；同时到达的查询 embedding 合成一个 batch 请求 Ollama
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from cache import normalize_question
+from index_cache import get_index
+from query_handler import handle_query_stream, retrieve_chunks, embed_queries
+from tracing import span
+
+# 常量
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 32            # 执行同步流水线（精炼、检索、流式生成）的线程数
+EMBED_WORKERS = 2               # 发送合批 embedding 请求的线程数（独立线程池：流水线线程全部在等 embedding 时仍能执行）
+INDEX_WORKERS = 2               # 执行 get_index（启动加载、/health、/sources）的线程数，同样独立于流水线线程池
+EMBED_TIMEOUT = 120             # 流水线线程等待合批 embedding 结果的最长秒数
+EMBED_BATCH_WINDOW = 0.01       # 第一条查询到达后等待同批查询的秒数
+EMBED_MAX_BATCH = 64            # 单个 embedding batch 的查询数上限（达到即立即发送）
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# 跨请求合批的查询 embedding：窗口内到达的不同查询一次请求 Ollama，相同查询只算一次
+class EmbedBatcher:
+    def __init__(self, executor: ThreadPoolExecutor, window: float = EMBED_BATCH_WINDOW, max_batch: int = EMBED_MAX_BATCH):
+        self._executor = executor
+        self._window = window
+        self._max_batch = max_batch
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer = None
+
+    async def embed(self, english_query: str) -> List[float]:
+        fut = self._pending.get(english_query)
+        if fut is None:
+            fut = self._pending[english_query] = asyncio.get_running_loop().create_future()
+            if len(self._pending) >= self._max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        return await asyncio.shield(fut)  # 某个等待方取消时不影响同批的其他请求
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: Dict[str, asyncio.Future]) -> None:
+        queries = list(batch)
+        try:
+            with span('embed_batch', queries=len(queries)):
+                vectors = await asyncio.get_running_loop().run_in_executor(self._executor, embed_queries, queries)
+        except Exception as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for query, vector in zip(queries, vectors):
+            if not batch[query].done():
+                batch[query].set_result(vector.tolist())
+
+# 一次在途的执行：记录已产出的事件，晚到的相同请求先回放已有事件，再接收后续事件
+class _Flight:
+    def __init__(self):
+        self.events: List[Tuple[str, object]] = []
+        self.finished = False
+        self._changed = asyncio.Condition()
+
+    async def push(self, event: str, payload: object, finished: bool = False) -> None:
+        async with self._changed:
+            self.events.append((event, payload))
+            self.finished = self.finished or finished
+            self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator[Tuple[str, object]]:
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: position < len(self.events) or self.finished)
+                events = self.events[position:]
+                finished = self.finished
+            position += len(events)
+            for item in events:
+                yield item
+            if finished and position >= len(self.events):
+                return
+
+class RetrievalService:
+    def __init__(self, workers: int = SERVICE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hayek-service')
+        # embedding 与索引加载不能与流水线共用线程池：流水线线程会阻塞等待 embedding，共用时线程耗尽即死锁
+        self._batcher = EmbedBatcher(ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix='hayek-embed'))
+        self._index_executor = ThreadPoolExecutor(max_workers=INDEX_WORKERS, thread_name_prefix='hayek-index')
+        self._flights: Dict[tuple, _Flight] = {}
+        self._loop = None
+
+    # 在工作线程中调用：把 embedding 交给事件循环上的合批器并等待结果
+    def _embed_blocking(self, english_query: str) -> List[float]:
+        with span('embed_query', batched=True):
+            fut = asyncio.run_coroutine_threadsafe(self._batcher.embed(english_query), self._loop)
+            try:
+                return fut.result(timeout=EMBED_TIMEOUT)
+            except FutureTimeoutError:
+                fut.cancel()
+                raise ValueError(f"Query embedding timed out after {EMBED_TIMEOUT}s. Ensure 'ollama serve' is running.")
+
+    # 相同 key 的请求共享一次执行；执行结束后移出在途表（之后的相同请求由各级缓存命中）
+    def _flight(self, key: tuple, produce) -> _Flight:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            task = asyncio.ensure_future(self._run_flight(flight, produce))
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        return flight
+
+    async def _run_flight(self, flight: _Flight, produce) -> None:
+        loop = self._loop
+
+        # 同步生成器在工作线程中迭代，每个事件送回事件循环分发
+        def drain() -> None:
+            for event, payload in produce():
+                asyncio.run_coroutine_threadsafe(flight.push(event, payload), loop).result()
+
+        try:
+            await loop.run_in_executor(self._executor, drain)
+        except Exception as e:
+            await flight.push('error', str(e), finished=True)
+        else:
+            await flight.push('end', None, finished=True)
+
+    # 流式查询：产出 (事件, 数据)，与 query_handler.handle_query_stream 相同，出错时产出 ('error', 消息)
+    async def query_stream(self, question: str, sources: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, object]]:
+        flight = self._flight(('query', normalize_question(question), _books_key(sources)),
+                              lambda: handle_query_stream(question, embed=self._embed_blocking, sources=sources))
+        async for event, payload in flight.subscribe():
+            if event != 'end':
+                yield event, payload
+
+    async def handle_query(self, question: str, sources: Optional[List[str]] = None) -> dict:
+        async for event, payload in self.query_stream(question, sources):
+            if event == 'done':
+                return payload
+            if event == 'error':
+                raise ValueError(payload)
+        raise ValueError("Query pipeline ended without a report.")
+
+    async def retrieve_chunks(self, english_query: str, sources: Optional[List[str]] = None) -> List[dict]:
+        def produce():
+            index, parents, subs, version = get_index()
+            yield 'chunks', retrieve_chunks(english_query, index, parents, subs, self._embed_blocking, sources)
+
+        async for event, payload in self._flight(('retrieve', english_query, _books_key(sources)), produce).subscribe():
+            if event == 'chunks':
+                return payload
+            if event == 'error':
+                raise ValueError(payload)
+        raise ValueError("Retrieval ended without results.")
+
+    # ---- HTTP（HTTP/1.1，每个连接一个请求）----
+    # POST /query          {"question": ..., "sources": [...]}       -> {"report", "chunks", "keywords"}
+    # POST /query_stream   {"question": ..., "sources": [...]}       -> 每行一个 JSON [事件, 数据]（chunked）
+    # POST /retrieve       {"english_query": ..., "sources": [...]}  -> {"chunks": [...]}
+    # GET  /sources                                                  -> {"sources": [可选的文档名]}
+    # GET  /health                                                   -> {"status": "ok", "index_version": ...}
+    # sources 可省略（检索全部书目）
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        streaming = False  # 已发出 chunked 响应头后，错误只能作为流中的事件返回
+        try:
+            method, path, body = await _read_request(reader)
+            if method == 'GET' and path == '/health':
+                snapshot = await self._loop.run_in_executor(self._index_executor, get_index)
+                await _send_json(writer, 200, {'status': 'ok', 'index_version': snapshot.version, 'in_flight': len(self._flights)})
+            elif method == 'GET' and path == '/sources':
+                snapshot = await self._loop.run_in_executor(self._index_executor, get_index)
+                await _send_json(writer, 200, {'sources': snapshot.index.sources})
+            elif method == 'POST' and path == '/query_stream':
+                question = body['question']
+                await _start_stream(writer)
+                streaming = True
+                async for event, payload in self.query_stream(question, body.get('sources')):
+                    await _send_chunk(writer, json.dumps([event, payload], ensure_ascii=False).encode('utf-8') + b'\n')
+                await _send_chunk(writer, b'')
+            elif method == 'POST' and path == '/query':
+                await _send_json(writer, 200, await self.handle_query(body['question'], body.get('sources')))
+            elif method == 'POST' and path == '/retrieve':
+                await _send_json(writer, 200, {'chunks': await self.retrieve_chunks(body['english_query'], body.get('sources'))})
+            else:
+                await _send_json(writer, 404, {'error': f"No route for {method} {path}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # 客户端已断开；在途执行照常完成（结果进入缓存，其他等待方不受影响）
+        except Exception as e:
+            if streaming:
+                # 不能再写一个 HTTP 响应（会混进 chunked 正文）：以 error 事件加结束 chunk 收尾，客户端按 error 事件处理
+                await _send_chunk(writer, json.dumps(['error', str(e)], ensure_ascii=False).encode('utf-8') + b'\n')
+                await _send_chunk(writer, b'')
+            elif isinstance(e, (KeyError, json.JSONDecodeError)):
+                await _send_json(writer, 400, {'error': f"Bad request: {e}"})
+            else:
+                await _send_json(writer, 500, {'error': str(e)})
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = SERVICE_HOST, port: int = SERVICE_PORT) -> None:
+        self._loop = asyncio.get_running_loop()
+        await self._loop.run_in_executor(self._index_executor, get_index)  # 启动时加载索引（必要时构建）
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Retrieval service listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+# 书目限定参与请求合并的 key：顺序与重复无关，空列表等同于不限定
+def _books_key(sources: Optional[List[str]]) -> tuple:
+    return tuple(sorted(set(sources))) if sources else ()
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple:
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) < 2:
+        raise ConnectionError("Empty request")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_REQUEST_BYTES:
+        raise ValueError("Request body too large.")
+    body = json.loads(await reader.readexactly(length)) if length else {}
+    return request_line[0].upper(), request_line[1].split('?', 1)[0], body
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, obj) -> None:
+    data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+
+async def _start_stream(writer: asyncio.StreamWriter) -> None:
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson; charset=utf-8\r\n"
+                 b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+
+# 写一个 chunk；空数据表示响应结束
+async def _send_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+    writer.write(f"{len(data):X}\r\n".encode('latin-1') + data + b"\r\n")
+    await writer.drain()
+
+# 命令行：python retrieval_service.py [--host 127.0.0.1] [--port 8765]；客户端设置 HAYEK_SERVICE_URL=http://127.0.0.1:8765
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve retrieval and reports from one shared index.")
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS)
+    args = parser.parse_args()
+    try:
+        asyncio.run(RetrievalService(args.workers).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
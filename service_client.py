@@ -0,0 +1,67 @@
+# service_client.py: retrieval_service.py 的瘦客户端（不加载索引、模型或 faiss），接口与 query_handler 中的同名函数一致
+import os
+import json
+import requests
+from typing import Iterator, List, Optional, Tuple
+
+# 常量
+SERVICE_URL = os.environ.get('HAYEK_SERVICE_URL', '')  # 例如 http://127.0.0.1:8765；为空时 app.py / main.py 在进程内加载索引
+SERVICE_CONNECT_TIMEOUT = 5     # 建立连接超时（秒）
+SERVICE_READ_TIMEOUT = 300      # 读取超时（秒；流式查询中为两个事件之间的最长间隔）
+
+class ServiceClient:
+    def __init__(self, base_url: str = SERVICE_URL):
+        self.base_url = base_url.rstrip('/')
+        self._session = requests.Session()
+
+    def _post(self, path: str, payload: dict, stream: bool = False) -> requests.Response:
+        try:
+            response = self._session.post(self.base_url + path, json=payload, stream=stream,
+                                          timeout=(SERVICE_CONNECT_TIMEOUT, SERVICE_READ_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Retrieval service error: {e}. Ensure 'python retrieval_service.py' is running.")
+        if response.status_code != 200:
+            try:
+                message = response.json().get('error')
+            except ValueError:
+                message = response.text
+            raise ValueError(f"Retrieval service error ({response.status_code}): {message}")
+        return response
+
+    # 流式工作流：产出 (事件, 数据)，与 query_handler.handle_query_stream 相同；sources 限定检索的书目
+    def handle_query_stream(self, chinese_question: str, sources: Optional[List[str]] = None) -> Iterator[Tuple[str, object]]:
+        response = self._post('/query_stream', {'question': chinese_question, 'sources': sources}, stream=True)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event, payload = json.loads(line)
+                if event == 'error':
+                    raise ValueError(payload)
+                yield event, payload
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Retrieval service stream error: {e}")
+        finally:
+            response.close()
+
+    def handle_query(self, chinese_question: str, sources: Optional[List[str]] = None) -> Tuple[str, List[dict], List[str]]:
+        result = self._post('/query', {'question': chinese_question, 'sources': sources}).json()
+        return result['report'], result['chunks'], result['keywords']
+
+    def retrieve_chunks(self, english_query: str, sources: Optional[List[str]] = None) -> List[dict]:
+        return self._post('/retrieve', {'english_query': english_query, 'sources': sources}).json()['chunks']
+
+    # 索引中的全部文档名（可用作 sources）
+    def list_sources(self) -> List[str]:
+        return self._get('/sources')['sources']
+
+    def health(self) -> dict:
+        return self._get('/health')
+
+    def _get(self, path: str) -> dict:
+        try:
+            response = self._session.get(self.base_url + path, timeout=(SERVICE_CONNECT_TIMEOUT, SERVICE_READ_TIMEOUT))
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Retrieval service error: {e}. Ensure 'python retrieval_service.py' is running.")
+        return response.json()
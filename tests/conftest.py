@@ -0,0 +1,5 @@
+# conftest.py: 测试直接导入仓库根目录下的模块（仓库没有打包成 package）
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,62 @@
+# test_chunk_store.py: 增量构建的缓冲写入不阻塞读取方（提交前读到旧数据，提交后读到新数据）
+import sqlite3
+import threading
+
+import pytest
+
+from chunk_store import ChunkStore
+
+def _seed(path):
+    store = ChunkStore(path, readonly=False)
+    store.insert_parent(1, 'old.epub', 'old parent', {'source_file': 'old.epub'})
+    store.insert_sub(1, 1, 'old.epub', 'old sub', {'source_file': 'old.epub', 'parent_id': 1})
+    store.commit()
+    store.close()
+
+def test_reader_is_not_locked_out_by_pending_incremental_writes(tmp_path):
+    path = str(tmp_path / 'chunks.db')
+    _seed(path)
+    writer = ChunkStore(path, readonly=False, buffered=True)
+    writer.delete_sources(['old.epub'])
+    text = 'x' * 4000
+    for i in range(2, 3000):  # 约 12MB，远超 SQLite 页缓存
+        writer.insert_parent(i, 'new.epub', text, {'source_file': 'new.epub'})
+        writer.insert_sub(i, i, 'new.epub', text[:500], {'source_file': 'new.epub', 'parent_id': i})
+
+    # 其他进程/线程中的只读连接（与 Streamlit 会话、检索服务相同）
+    results = []
+    def read():
+        reader = ChunkStore(path)
+        results.append((reader.parents.get_many([0]), reader.subs.get_many([0]), reader.parent_counts()))
+        reader.close()
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    parents, subs, counts = results[0]
+    assert parents == [{'text': 'old parent', 'metadata': {'source_file': 'old.epub'}}]
+    assert subs[0]['text'] == 'old sub'
+    assert counts == {'old.epub': 1}
+    assert writer.last_id('parents') == 2999  # 新 ID 在提交前已分配
+
+    writer.commit()
+    writer.close()
+    reader = ChunkStore(path)
+    assert reader.parents.get_many([0]) == [None]
+    assert reader.parent_counts() == {'new.epub': 2998}
+    assert len(reader.subs) == 2999
+    assert reader.subs.get_many([2998])[0]['text'] == text[:500]
+    reader.close()
+
+def test_failed_commit_keeps_old_data(tmp_path):
+    path = str(tmp_path / 'chunks.db')
+    _seed(path)
+    writer = ChunkStore(path, readonly=False, buffered=True)
+    writer.delete_sources(['old.epub'])
+    writer.insert_parent(2, 'new.epub', 'new parent', {})
+    writer.insert_parent(2, 'new.epub', 'duplicate id', {})  # 主键冲突
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.commit()
+    writer.close()
+    reader = ChunkStore(path)
+    assert reader.parent_counts() == {'old.epub': 1}
+    reader.close()
@@ -0,0 +1,71 @@
+# test_chunking.py: iter_chunks 的 offset 与切分性质（块文本即全文切片、长度不超限、覆盖全文）
+import random
+
+import pytest
+
+utils = pytest.importorskip('utils')  # utils 依赖 requests / PyPDF2 / ebooklib 等，缺依赖时跳过
+
+WORDS = ['liberty', 'order', 'price', 'market', 'knowledge', 'planning', 'a', 'of', 'the',
+         'Mr.', 'e.g.', 'spontaneous', 'x' * 120]
+
+def _random_unit(rng: random.Random) -> str:
+    paragraphs = []
+    for _ in range(rng.randint(0, 4)):
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(1, 40))]
+            sentences.append(' '.join(words) + rng.choice(['.', '?', '']))
+        paragraphs.append(rng.choice([' ', '  ', '\n']).join(sentences))
+    return rng.choice(['\n\n', '\n \n', '\n\n\n']).join(paragraphs)
+
+def _check(units, max_chunk_size, overlap):
+    full = utils.UNIT_SEPARATOR.join(u for u in units if u)
+    chunks = list(utils.iter_chunks(units, max_chunk_size, overlap))
+    covered = [False] * len(full)
+    previous_start = -1
+    for chunk in chunks:
+        start, end = chunk['start'], chunk['end']
+        assert chunk['text'] == full[start:end]
+        assert 0 < end - start <= max_chunk_size
+        assert start > previous_start  # 块按文档顺序产出
+        previous_start = start
+        for i in range(start, end):
+            covered[i] = True
+    # 所有非空白字符都落在某个块里
+    missing = [i for i, c in enumerate(full) if not c.isspace() and not covered[i]]
+    assert not missing, full[missing[0]:missing[0] + 40]
+    return chunks
+
+@pytest.mark.parametrize('seed', range(200))
+def test_random_units(seed):
+    rng = random.Random(seed)
+    units = [_random_unit(rng) for _ in range(rng.randint(1, 5))]
+    _check(units, rng.choice([30, 80, 200, 500]), rng.choice([0, 10, 50]))
+
+def test_offsets_span_units():
+    units = ['First page text.', '', 'Second page text.']
+    chunks = _check(units, 500, 50)
+    assert len(chunks) == 1
+    assert chunks[0]['text'] == 'First page text.' + utils.UNIT_SEPARATOR + 'Second page text.'
+
+def test_overlap_between_adjacent_chunks():
+    text = ' '.join(f'Sentence number {i}.' for i in range(60))  # 句子短于 max - overlap，重叠总能放下
+    chunks = _check([text], 100, 30)
+    assert len(chunks) > 1
+    for a, b in zip(chunks, chunks[1:]):
+        assert b['start'] < a['end']  # 相邻块有重叠
+        assert b['start'] == 0 or text[b['start'] - 1] == ' '  # 重叠对齐到词边界
+
+def test_no_overlap():
+    text = ' '.join(f'word{i}' for i in range(200))
+    chunks = _check([text], 100, 0)
+    for a, b in zip(chunks, chunks[1:]):
+        assert b['start'] >= a['end']
+
+def test_empty_input():
+    assert list(utils.iter_chunks([], 100, 10)) == []
+    assert list(utils.iter_chunks(['', '  \n\n '], 100, 10)) == []
+
+def test_recursive_split_text_matches_iter_chunks():
+    text = 'One sentence here. Another one there.\n\nA new paragraph follows.'
+    assert utils.recursive_split_text(text, 30, 0) == [c['text'] for c in utils.iter_chunks([text], 30, 0)]
@@ -0,0 +1,79 @@
+# test_context_packing.py: pack_context 的合并、排名、去重、锚点截断与预算性质
+from context_packing import MERGE_MAX_GAP, MIN_PARTIAL_TOKENS, estimate_tokens, pack_context
+
+# 模拟 data/processed 中的一本书，父块是它的切片
+DOC = ' '.join(f'Sentence {i} about the market order.' for i in range(400))
+
+def _chunk(start, end, source='book.epub', text=None):
+    return {'text': DOC[start:end] if text is None else text,
+            'metadata': {'source_file': source, 'char_start': start, 'char_end': end}}
+
+def test_overlapping_parents_merge_without_duplicate_text():
+    packed = pack_context([_chunk(100, 400), _chunk(300, 700)], token_budget=10000)
+    assert packed == [DOC[100:700]]
+
+def test_adjacent_parents_merge_in_document_order():
+    gap = MERGE_MAX_GAP // 2
+    packed = pack_context([_chunk(600, 800), _chunk(300, 600 - gap)], token_budget=10000)
+    assert packed == [DOC[300:600 - gap] + '\n\n' + DOC[600:800]]
+
+def test_bridging_parent_merges_transitively():
+    # 相邻父块（PARENT_OVERLAP=100）按排名 1、3、2 返回：第 2 块把前两段连起来，结果只有一段，重叠部分不重复
+    packed = pack_context([_chunk(0, 2000), _chunk(3800, 5800), _chunk(1900, 3900)], token_budget=10000)
+    assert packed == [DOC[0:5800]]
+
+def test_bridging_parent_keeps_earlier_rank_position():
+    first = _chunk(9000, 9300)
+    packed = pack_context([first, _chunk(3800, 5800), _chunk(0, 2000), _chunk(1900, 3900)], token_budget=10000)
+    assert packed == [DOC[9000:9300], DOC[0:5800]]
+
+def test_bridged_passage_truncates_from_top_ranked_anchor():
+    packed = pack_context([_chunk(3800, 5800), _chunk(0, 2000), _chunk(1900, 3900)], token_budget=100)
+    assert len(packed) == 1
+    assert packed[0].startswith(DOC[3800:3850])
+
+def test_distant_or_other_source_parents_stay_separate_in_rank_order():
+    far = 700 + MERGE_MAX_GAP + 1
+    chunks = [_chunk(far, far + 300), _chunk(100, 400), _chunk(100, 400, source='other.pdf',
+                                                                 text='Unrelated words on money and credit.')]
+    packed = pack_context(chunks, token_budget=10000)
+    assert packed == [DOC[far:far + 300], DOC[100:400], 'Unrelated words on money and credit.']
+
+def test_near_duplicates_keep_higher_ranked_passage():
+    first = _chunk(0, 500, source='a.pdf')
+    copy = _chunk(0, 480, source='b.pdf', text=DOC[10:480])  # 另一本书里的同一段文字
+    other = _chunk(2000, 2300)
+    assert pack_context([first, copy, other], token_budget=10000) == [DOC[0:500], DOC[2000:2300]]
+
+def test_chunks_without_offsets_are_not_merged():
+    chunks = [{'text': 'Prices convey knowledge.', 'metadata': {'source_file': 'a.pdf'}},
+              {'text': 'Planning replaces competition.', 'metadata': {'source_file': 'a.pdf'}}]
+    assert pack_context(chunks, token_budget=10000) == ['Prices convey knowledge.', 'Planning replaces competition.']
+
+def test_budget_is_respected():
+    chunks = [_chunk(s, s + 600) for s in range(0, 12000, 1000)]
+    budget = 500
+    packed = pack_context(chunks, token_budget=budget)
+    assert packed
+    assert sum(estimate_tokens(t) for t in packed) <= budget
+
+def test_top_passage_is_truncated_not_dropped():
+    packed = pack_context([_chunk(0, 4000)], token_budget=100)
+    assert len(packed) == 1
+    assert 0 < estimate_tokens(packed[0]) <= 100
+    assert DOC.startswith(packed[0])
+
+def test_truncation_keeps_top_ranked_anchor():
+    # 排名第一的父块在后，合并后的文本从 2000 开始；截断必须从排名第一的父块起点保留
+    packed = pack_context([_chunk(2000, 3000), _chunk(1500, 2100)], token_budget=100)
+    assert len(packed) == 1
+    assert DOC[2000:].startswith(packed[0])
+    assert packed[0].startswith(DOC[2000:2050])
+
+def test_small_remainder_skips_long_passage_but_keeps_shorter_one():
+    first = _chunk(0, 1600)
+    budget = estimate_tokens(DOC[0:1600]) + MIN_PARTIAL_TOKENS - 1
+    long_passage = _chunk(4000, 6000)
+    short_passage = _chunk(9000, 9100)
+    packed = pack_context([first, long_passage, short_passage], token_budget=budget)
+    assert packed == [DOC[0:1600], DOC[9000:9100]]
@@ -0,0 +1,31 @@
+# test_index_io.py: 每种 INDEX_TYPES 写出后都能以内存映射读回（不退回整体读入），搜索结果不变
+import pytest
+
+np = pytest.importorskip('numpy')
+faiss = pytest.importorskip('faiss')
+
+from vector_index import INDEX_TYPES, add_vectors, create_index, read_index_file
+
+DIM = 16
+N = 1000  # 足够训练 IVF / IVF-PQ，不会降级为 flat
+
+@pytest.fixture(scope='module')
+def vectors():
+    return np.random.default_rng(0).standard_normal((N, DIM)).astype(np.float32)
+
+@pytest.mark.parametrize('index_type', INDEX_TYPES)
+def test_index_is_memory_mapped(index_type, vectors, tmp_path, capsys):
+    index = create_index(index_type, vectors)
+    add_vectors(index, vectors, np.arange(N, dtype=np.int64) + 10)
+    path = str(tmp_path / f'{index_type}.faiss')
+    faiss.write_index(index, path)
+    capsys.readouterr()
+
+    loaded = read_index_file(path, mmap=True)
+    assert 'Memory-mapped load' not in capsys.readouterr().out
+    assert loaded.ntotal == N
+    queries = vectors[:5]
+    expected = read_index_file(path, mmap=False).search(queries, 3)  # 同样的查询参数（nprobe / efSearch）
+    got = loaded.search(queries, 3)
+    np.testing.assert_allclose(got[0], expected[0], rtol=1e-5)
+    assert (got[1] == expected[1]).all()
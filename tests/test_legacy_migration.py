@@ -0,0 +1,63 @@
+# test_legacy_migration.py: 基线安装（hayek_metadata.json + 单一 IndexFlatL2）迁移后直接可用，不重新 embedding
+import json
+
+import pytest
+
+np = pytest.importorskip('numpy')
+faiss = pytest.importorskip('faiss')
+indexing = pytest.importorskip('indexing')  # 依赖 utils / embedding 的 I/O 库，缺少时跳过
+
+DIM = 8
+BOOKS = {'a.pdf': 3, 'b.epub': 2}  # 每本书的父块数，每个父块两个子块
+
+# 按基线 indexing.py 的格式写出 hayek_metadata.json 与 hayek_index.faiss
+def _write_baseline_install(root):
+    data_dir = root / 'data' / 'test'
+    data_dir.mkdir(parents=True)
+    parents, subs = [], []
+    for book, n_parents in BOOKS.items():
+        (data_dir / book).write_bytes(book.encode() * 100)
+        for local in range(n_parents):
+            parents.append({'text': f'{book} parent {local} ' * 20,
+                            'metadata': {'source_file': book, 'chunk_id': f'parent_{len(parents) + 1:04d}', 'page_estimate': local + 1}})
+            for _ in range(2):
+                subs.append({'text': f'{book} sub {len(subs)} ' * 10,
+                             'metadata': {'source_file': book, 'chunk_id': f'sub_{len(subs) + 1:04d}', 'page_estimate': local + 1,
+                                          'parent_id': len(parents)}})
+    with open(root / indexing.METADATA_FILE, 'w', encoding='utf-8') as f:
+        json.dump({'parents': parents, 'subs': subs}, f)
+    vectors = np.random.default_rng(0).standard_normal((len(subs), DIM)).astype(np.float32)
+    index = faiss.IndexFlatL2(DIM)
+    index.add(vectors)
+    faiss.write_index(index, str(root / indexing.LEGACY_INDEX_FILE))
+    return vectors, subs
+
+def _no_embedding(texts, *args, **kwargs):
+    assert not list(texts), 'sub-chunks were re-embedded'
+    return np.zeros((0, DIM), dtype=np.float32)
+
+def test_baseline_install_keeps_its_vectors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    vectors, subs = _write_baseline_install(tmp_path)
+    monkeypatch.setattr(indexing, 'embed_texts', _no_embedding)
+
+    index, parents, sub_table = indexing.load_index()
+    assert index.ntotal == len(subs)
+    assert index.sources == sorted(BOOKS)
+    _, ids = index.search(vectors, 1)
+    assert (ids[:, 0] == np.arange(len(subs))).all()  # 每个向量仍对应原来的子块
+    assert sub_table[4]['text'] == subs[4]['text']
+    assert not indexing.index_is_stale()
+    with open(indexing.MANIFEST_FILE, encoding='utf-8') as f:
+        assert json.load(f)['settings'] == indexing._index_settings()
+
+def test_books_removed_since_baseline_are_dropped_without_re_embedding(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    vectors, subs = _write_baseline_install(tmp_path)
+    (tmp_path / 'data' / 'test' / 'b.epub').unlink()
+    monkeypatch.setattr(indexing, 'embed_texts', _no_embedding)
+
+    index, _, _ = indexing.load_index()
+    assert index.sources == ['a.pdf']
+    assert index.ntotal == 2 * BOOKS['a.pdf']
+    assert not indexing.index_is_stale()
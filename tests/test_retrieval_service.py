@@ -0,0 +1,56 @@
+# test_retrieval_service.py: 流式响应开始后出错时，以 error 事件与结束 chunk 收尾（不在 chunked 正文中再写一个 HTTP 响应）
+import asyncio
+import json
+
+import pytest
+
+retrieval_service = pytest.importorskip('retrieval_service')  # 依赖 numpy / faiss / ollama 等，缺少时跳过
+
+async def _request(port: int, path: str, body: dict) -> bytes:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode('utf-8')
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+def _decode_chunked(body: bytes) -> bytes:
+    out = b''
+    while True:
+        size_line, _, body = body.partition(b'\r\n')
+        size = int(size_line, 16)
+        if size == 0:
+            assert body == b'\r\n'
+            return out
+        out += body[:size]
+        assert body[size:size + 2] == b'\r\n'
+        body = body[size + 2:]
+
+async def _serve_and_request(service, path: str, body: dict) -> bytes:
+    service._loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(service._handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        return await _request(port, path, body)
+
+def test_error_after_stream_started_is_sent_as_event():
+    service = retrieval_service.RetrievalService(workers=1)
+
+    async def failing_stream(question, sources=None):
+        yield 'keywords', ['liberty']
+        raise RuntimeError('pipeline failed')
+    service.query_stream = failing_stream
+
+    response = asyncio.run(_serve_and_request(service, '/query_stream', {'question': '自由'}))
+    head, _, body = response.partition(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert b'Transfer-Encoding: chunked' in head
+    events = [json.loads(line) for line in _decode_chunked(body).decode('utf-8').splitlines()]
+    assert events == [['keywords', ['liberty']], ['error', 'pipeline failed']]
+
+def test_bad_request_before_stream_gets_400():
+    service = retrieval_service.RetrievalService(workers=1)
+    response = asyncio.run(_serve_and_request(service, '/query_stream', {}))
+    assert response.startswith(b'HTTP/1.1 400 Bad Request')
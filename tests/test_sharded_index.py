@@ -0,0 +1,80 @@
+# test_sharded_index.py: ShardedIndex.search 合并各分片结果（与单个全量索引一致、-1 补位排在最后、按书目过滤）
+import pytest
+
+np = pytest.importorskip('numpy')
+faiss = pytest.importorskip('faiss')
+
+from vector_index import ShardedIndex
+
+DIM = 8
+
+def _shard(vectors, ids):
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    if len(ids):
+        index.add_with_ids(np.asarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    return index
+
+def _corpus(seed=0, sizes=(40, 3, 25)):
+    rng = np.random.default_rng(seed)
+    shards, all_vectors, all_ids = {}, [], []
+    next_id = 0
+    for n, size in enumerate(sizes):
+        vectors = rng.standard_normal((size, DIM)).astype(np.float32)
+        ids = np.arange(next_id, next_id + size, dtype=np.int64)
+        next_id += size
+        shards[f'book{n}.epub'] = _shard(vectors, ids)
+        all_vectors.append(vectors)
+        all_ids.append(ids)
+    return shards, np.concatenate(all_vectors), np.concatenate(all_ids), rng
+
+def test_merged_results_match_single_index():
+    shards, vectors, ids, rng = _corpus()
+    queries = rng.standard_normal((5, DIM)).astype(np.float32)
+    sharded = ShardedIndex(shards)
+    assert sharded.ntotal == len(ids)
+    distances, got = sharded.search(queries, 10)
+    expected_distances, expected = _shard(vectors, ids).search(queries, 10)
+    assert got.shape == (5, 10)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+    assert (got == expected).all()
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+def test_short_results_are_padded_with_minus_one_at_the_end():
+    shards, _, ids, rng = _corpus(sizes=(2, 3))
+    queries = rng.standard_normal((3, DIM)).astype(np.float32)
+    distances, got = ShardedIndex(shards).search(queries, 8)
+    assert got.shape == (3, 8)
+    for row, dist in zip(got, distances):
+        assert sorted(row[:5]) == sorted(ids)
+        assert (row[5:] == -1).all()
+        assert np.isfinite(dist[:5]).all() and np.isinf(dist[5:]).all()
+
+def test_empty_shard_does_not_displace_results():
+    shards, _, ids, rng = _corpus(sizes=(4, 0, 6))
+    distances, got = ShardedIndex(shards).search(rng.standard_normal((2, DIM)).astype(np.float32), 10)
+    for row in got:
+        assert sorted(row) == sorted(ids)
+
+def test_sources_filter_searches_only_selected_books():
+    shards, _, _, rng = _corpus()
+    queries = rng.standard_normal((4, DIM)).astype(np.float32)
+    sharded = ShardedIndex(shards)
+    selected = ['book0.epub', 'book2.epub']
+    _, got = sharded.search(queries, 6, sources=selected + ['book2.epub', 'missing.pdf'])
+    allowed = set()
+    for name in selected:
+        allowed.update(faiss.vector_to_array(shards[name].id_map).tolist())
+    assert set(got.ravel().tolist()) <= allowed
+    _, single = sharded.search(queries, 6, sources=['book1.epub'])
+    _, direct = shards['book1.epub'].search(queries, 6)
+    assert (single == direct).all()
+
+def test_unknown_sources_return_only_padding():
+    shards, _, _, rng = _corpus()
+    distances, got = ShardedIndex(shards).search(rng.standard_normal((2, DIM)).astype(np.float32), 5, sources=['missing.pdf'])
+    assert got.shape == (2, 5) and (got == -1).all()
+    assert np.isinf(distances).all()
+
+def test_sources_lists_shard_names():
+    shards, _, _, _ = _corpus()
+    assert ShardedIndex(shards).sources == sorted(shards)
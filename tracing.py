@@ -0,0 +1,115 @@
+# tracing.py: 轻量级分阶段计时（span），结果写入 JSON-lines 日志并在内存中保留最近记录供 UI 展示
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# 常量
+TRACE_ENABLED = True
+TRACE_LOG_FILE = 'hayek_trace.jsonl'
+TRACE_LOG_MAX_BYTES = 16 * 1024 * 1024   # 日志超过该大小时轮转为 .1（只保留一份旧日志）
+TRACE_RECENT_SPANS = 2000                # 内存中保留的最近 span 数
+
+_current = contextvars.ContextVar('hayek_current_span', default=None)
+_recent = deque(maxlen=TRACE_RECENT_SPANS)
+_write_lock = threading.Lock()
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'], attrs: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = dict(attrs)
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+
+    # 追加属性（如 token 数、字节数、是否命中缓存）
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    # 自 span 开始以来的秒数（用于记录首 token 等阶段内时间点）
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._t0
+
+    def to_record(self, duration: float, status: str) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': duration * 1000,
+            'status': status,
+            'attrs': self.attrs,
+        }
+
+def _write(record: dict) -> None:
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    with _write_lock:
+        _recent.append(record)
+        try:
+            if os.path.exists(TRACE_LOG_FILE) and os.path.getsize(TRACE_LOG_FILE) > TRACE_LOG_MAX_BYTES:
+                os.replace(TRACE_LOG_FILE, TRACE_LOG_FILE + '.1')
+            with open(TRACE_LOG_FILE, 'a', encoding='utf-8') as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Trace write error: {e}")
+
+# 计时一个阶段：with span('refine_query', cached=False) as s: ...; 嵌套的 span 自动记录父子关系
+# 异常会记录为 status='error' 并照常抛出；生成器被提前关闭（GeneratorExit）记录为 'cancelled'
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    if not TRACE_ENABLED:
+        yield Span(name, None, attrs)
+        return
+    s = Span(name, _current.get(), attrs)
+    token = _current.set(s)
+    status = 'ok'
+    try:
+        yield s
+    except GeneratorExit:
+        status = 'cancelled'
+        raise
+    except BaseException as e:
+        status = 'error'
+        s.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            _current.set(None)  # 在另一个 context 中结束（如生成器跨线程消费），直接清空
+        _write(s.to_record(time.perf_counter() - s._t0, status))
+
+# 最近的 span 记录（新的在后）；name 不为空时只返回该阶段
+def recent_spans(name: str = None, limit: int = None) -> List[dict]:
+    with _write_lock:
+        records = [r for r in _recent if name is None or r['name'] == name]
+    return records[-limit:] if limit else records
+
+# 最近的若干次 trace（按根 span 名过滤），每次 trace 汇总为 {阶段名: 累计毫秒}
+def recent_traces(root: str, limit: int = 20) -> List[dict]:
+    with _write_lock:
+        records = list(_recent)
+    roots = [r for r in records if r['name'] == root and r['parent_id'] is None][-limit:]
+    wanted = {r['trace_id'] for r in roots}
+    stages: Dict[str, Dict[str, float]] = {tid: {} for tid in wanted}
+    for r in records:
+        if r['trace_id'] in wanted and r['parent_id'] is not None:
+            per_trace = stages[r['trace_id']]
+            per_trace[r['name']] = per_trace.get(r['name'], 0.0) + r['duration_ms']
+    return [dict(root=r, stages=stages[r['trace_id']]) for r in roots]
+
+# 各阶段的耗时样本（毫秒），用于直方图
+def stage_durations() -> Dict[str, List[float]]:
+    durations: Dict[str, List[float]] = {}
+    with _write_lock:
+        for r in _recent:
+            durations.setdefault(r['name'], []).append(r['duration_ms'])
+    return durations
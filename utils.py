@@ -1,84 +1,175 @@
 # utils.py: 通用帮助函数模块
 import os
 import json
+import time
+import random
+import asyncio
+import threading
+import weakref
+import html
 import requests
+import httpx
 import re
-from typing import List
+from typing import Iterable, Iterator, List, Tuple, Union
+from requests.adapters import HTTPAdapter
 import PyPDF2
 from ebooklib import epub
 import ebooklib  # 导入 ebooklib 以访问 ITEM_DOCUMENT
 from dotenv import load_dotenv  # 新增：加载 .env 文件
+from tracing import span  # LLM 调用的计时与 token/字节统计
 
 # 常量（如果需要，可以移到单独的 config.py，但现在简单点）
-DEEPSEEK_API_URL = 'https://api.deepseek.com/v1/chat/completions'
+DEEPSEEK_API_URL = os.environ.get('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')  # 可指向本地 stub（见 benchmark.py）
 MODEL_NAME = 'deepseek-chat'
 TEMPERATURE = 0.7
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
+DEEPSEEK_CONNECT_TIMEOUT = 10      # 建立连接超时（秒）
+DEEPSEEK_READ_TIMEOUT = 180        # 读取响应超时（秒）
+DEEPSEEK_MAX_RETRIES = 3           # 429/5xx/网络错误的最大重试次数
+DEEPSEEK_RETRY_BASE_DELAY = 1.0    # 退避基准秒数（full jitter）
+DEEPSEEK_MAX_CONCURRENCY = 8       # 单进程同时在途的 DeepSeek 请求上限
+DEEPSEEK_POOL_SIZE = 16            # 连接池大小（keep-alive 复用 TLS 连接）
+_RETRY_STATUS = {429, 500, 502, 503, 504}
 
-# Helper function to extract text from PDF
-def extract_text_from_pdf(file_path: str) -> str:
+UNIT_SEPARATOR = '\n\n'  # 页/章节之间的分隔，与 data/processed 中保存的全文一致（offset 以此为准）
+
+# 逐页产出 (页码, 清洗后的文本)，不在内存中拼接整本书
+def iter_pdf_pages(file_path: str) -> Iterator[Tuple[int, str]]:
     try:
         with open(file_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
-            text = ''
-            for page in reader.pages:
-                text += page.extract_text() + '\n'
-            text = clean_text(text)
-            return text
+            for page_number, page in enumerate(reader.pages, start=1):
+                yield page_number, clean_text(page.extract_text() or '')
     except Exception as e:
         raise ValueError(f"Error reading PDF {file_path}: {e}")
 
-# Helper function to extract text from EPUB
-def extract_text_from_epub(file_path: str) -> str:
+# 逐个 EPUB 文档（章节文件）产出 (章节序号, 清洗后的文本)
+def iter_epub_documents(file_path: str) -> Iterator[Tuple[int, str]]:
     try:
         book = epub.read_epub(file_path)
-        text = ''
-        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-            text += item.get_content().decode('utf-8') + '\n'
-        # 新增：清洗文本
-        text = clean_text(text)
-        return text
+        for section_number, item in enumerate(book.get_items_of_type(ebooklib.ITEM_DOCUMENT), start=1):
+            yield section_number, clean_text(item.get_content().decode('utf-8', errors='replace'))
     except Exception as e:
         raise ValueError(f"Error reading EPUB {file_path}: {e}")
 
+# Helper function to extract text from PDF
+def extract_text_from_pdf(file_path: str) -> str:
+    return UNIT_SEPARATOR.join(text for _, text in iter_pdf_pages(file_path) if text)
+
+# Helper function to extract text from EPUB
+def extract_text_from_epub(file_path: str) -> str:
+    return UNIT_SEPARATOR.join(text for _, text in iter_epub_documents(file_path) if text)
+
+_SENTENCE_BOUNDARY = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s')
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# 去掉 [start, end) 两端的空白后的区间；全为空白时返回 None
+def _strip_span(text: str, start: int, end: int):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return (start, end) if start < end else None
+
+# 超长句子按长度硬切，尽量切在空格处
+def _hard_split(text: str, start: int, end: int, max_chunk_size: int) -> Iterator[Tuple[int, int]]:
+    while end - start > max_chunk_size:
+        cut = text.rfind(' ', start + 1, start + max_chunk_size + 1)
+        if cut <= start:
+            cut = start + max_chunk_size
+        yield start, cut
+        start = cut
+        while start < end and text[start].isspace():
+            start += 1
+    if start < end:
+        yield start, end
+
+# 产出 text 中的原子片段 (start, end)：不超长的段落整体产出，超长段落按句子，超长句子再硬切
+def _iter_segments(text: str, max_chunk_size: int) -> Iterator[Tuple[int, int]]:
+    pos = 0
+    breaks = [m.span() for m in _PARAGRAPH_BREAK.finditer(text)] + [(len(text), len(text))]
+    for break_start, break_end in breaks:
+        para = _strip_span(text, pos, break_start)
+        pos = break_end
+        if para is None:
+            continue
+        p_start, p_end = para
+        if p_end - p_start <= max_chunk_size:
+            yield para
+            continue
+        sent_start = p_start
+        bounds = [m.start() for m in _SENTENCE_BOUNDARY.finditer(text, p_start, p_end)] + [p_end]
+        for bound in bounds:
+            sent = _strip_span(text, sent_start, bound)
+            sent_start = bound
+            if sent is not None:
+                yield from _hard_split(text, sent[0], sent[1], max_chunk_size)
+
+# Streaming splitter: 把连续的文本单元（页/章节）切成不超过 max_chunk_size 的块
+# 产出 {'text', 'start', 'end'}，offset 基于以 UNIT_SEPARATOR 连接全部非空单元得到的全文；
+# 相邻块之间保留约 overlap 个字符的重叠（对齐到词边界）。只保留当前块附近的文本，内存不随全文增长。
+def iter_chunks(units: Iterable[str], max_chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> Iterator[dict]:
+    window = ''        # 覆盖全文 [window_start, window_start + len(window)) 的文本
+    window_start = 0
+    offset = 0         # 下一个单元在全文中的起点
+    chunk_start = None
+    chunk_end = 0
+
+    def emit() -> dict:
+        return {'text': window[chunk_start - window_start:chunk_end - window_start],
+                'start': chunk_start, 'end': chunk_end}
+
+    for text in units:
+        if not text:
+            continue
+        if offset:
+            window += UNIT_SEPARATOR
+            offset += len(UNIT_SEPARATOR)
+        window += text
+        for seg_start, seg_end in _iter_segments(text, max_chunk_size):
+            seg_start += offset
+            seg_end += offset
+            if chunk_start is None:
+                chunk_start = seg_start
+            elif seg_end - chunk_start > max_chunk_size:
+                yield emit()
+                new_start = seg_start
+                if overlap > 0:
+                    tail = max(chunk_start, chunk_end - overlap)
+                    space = window.find(' ', tail - window_start, chunk_end - window_start)
+                    if space != -1:
+                        tail = window_start + space + 1
+                    if tail < chunk_end and seg_end - tail <= max_chunk_size:
+                        new_start = tail
+                chunk_start = new_start
+                window = window[chunk_start - window_start:]
+                window_start = chunk_start
+            chunk_end = seg_end
+        offset += len(text)
+    if chunk_start is not None:
+        yield emit()
+
 # Recursive text splitter: split into paragraphs, then sentences, then chunks
 def recursive_split_text(text: str, max_chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
-    def split_into_paragraphs(t: str) -> List[str]:
-        return [p.strip() for p in t.split('\n\n') if p.strip()]
-
-    def split_into_sentences(p: str) -> List[str]:
-        sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', p)
-        return [s.strip() for s in sentences if s.strip()]
-
-    chunks = []
-    paragraphs = split_into_paragraphs(text)
-    for para in paragraphs:
-        if len(para) <= max_chunk_size:
-            chunks.append(para)
-        else:
-            sentences = split_into_sentences(para)
-            current_chunk = ''
-            for sent in sentences:
-                if len(current_chunk) + len(sent) <= max_chunk_size:
-                    current_chunk += sent + ' '
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = sent[-overlap:] + sent if len(sent) > overlap else sent
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-    return chunks
+    return [chunk['text'] for chunk in iter_chunks([text], max_chunk_size, overlap)]
 
-# Helper function for DeepSeek API call
-def call_deepseek_api(prompt: str, system_prompt: str = "") -> str:
-    load_dotenv()  # 新增：加载 .env 文件（确保 API key 被读取）
+# 只在首次调用时加载 .env，之后直接读环境变量
+_dotenv_loaded = False
+
+def _get_api_key() -> str:
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        load_dotenv()  # 加载 .env 文件（确保 API key 被读取）
+        _dotenv_loaded = True
     api_key = os.environ.get("DEEPSEEK_API_KEY")
     if not api_key:
         raise ValueError("DEEPSEEK_API_KEY not set in environment variables or .env file.")
+    return api_key
 
+def _build_request(prompt: str, system_prompt: str, stream: bool = False) -> tuple:
     headers = {
-        "Authorization": f"Bearer {api_key}",
+        "Authorization": f"Bearer {_get_api_key()}",
         "Content-Type": "application/json"
     }
     data = {
@@ -89,19 +180,204 @@ def call_deepseek_api(prompt: str, system_prompt: str = "") -> str:
             {"role": "user", "content": prompt}
         ]
     }
-    try:
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
-        return result['choices'][0]['message']['content'].strip()
-    except requests.exceptions.RequestException as e:
-        raise ValueError(f"DeepSeek API error: {e}")
+    if stream:
+        data["stream"] = True
+        data["stream_options"] = {"include_usage": True}  # 最后一个事件附带 token 用量
+    return headers, data
+
+# LLM 调用 span 的请求侧属性
+def _request_attrs(data: dict) -> dict:
+    return {
+        'model': data['model'],
+        'stream': bool(data.get('stream')),
+        'prompt_chars': sum(len(m['content']) for m in data['messages']),
+        'request_bytes': len(json.dumps(data).encode('utf-8')),
+    }
+
+# 记录响应侧属性：字节数与 API 返回的 token 用量（usage 缺失时只记字节）
+def _record_response(s, response_bytes: int, usage) -> None:
+    s.set(response_bytes=response_bytes)
+    if usage:
+        s.set(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+
+# 解析一行 SSE（"data: {...}"），返回 (增量文本, usage)；流结束（[DONE]）返回 None
+def _parse_stream_line(line: str):
+    if not line or not line.startswith('data:'):
+        return '', None
+    payload = line[len('data:'):].strip()
+    if payload == '[DONE]':
+        return None
+    chunk = json.loads(payload)
+    choices = chunk.get('choices') or [{}]
+    return choices[0].get('delta', {}).get('content') or '', chunk.get('usage')
+
+# 退避时长：优先遵循 Retry-After，否则指数退避 + full jitter
+def _retry_delay(attempt: int, retry_after: str = None) -> float:
+    if retry_after:
+        try:
+            return min(float(retry_after), 60.0)
+        except ValueError:
+            pass
+    return random.uniform(0, DEEPSEEK_RETRY_BASE_DELAY * (2 ** attempt))
+
+# 复用连接池的同步客户端：keep-alive、连接/读取超时、429/5xx 重试、并发上限
+class DeepSeekClient:
+    def __init__(self, pool_size: int = DEEPSEEK_POOL_SIZE, max_concurrency: int = DEEPSEEK_MAX_CONCURRENCY):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def chat(self, prompt: str, system_prompt: str = "") -> str:
+        headers, data = _build_request(prompt, system_prompt)
+        with span('llm', **_request_attrs(data)) as s, self._semaphore:
+            for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+                try:
+                    response = self._session.post(DEEPSEEK_API_URL, headers=headers, json=data,
+                                                  timeout=(DEEPSEEK_CONNECT_TIMEOUT, DEEPSEEK_READ_TIMEOUT))
+                    if response.status_code in _RETRY_STATUS and attempt < DEEPSEEK_MAX_RETRIES:
+                        delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                        print(f"DeepSeek API returned {response.status_code}, retrying in {delay:.1f}s...")
+                        time.sleep(delay)
+                        continue
+                    response.raise_for_status()
+                    result = response.json()
+                    s.set(attempts=attempt + 1)
+                    _record_response(s, len(response.content), result.get('usage'))
+                    return result['choices'][0]['message']['content'].strip()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt >= DEEPSEEK_MAX_RETRIES:
+                        raise ValueError(f"DeepSeek API error: {e}")
+                    delay = _retry_delay(attempt)
+                    print(f"DeepSeek API request failed ({e}), retrying in {delay:.1f}s...")
+                    time.sleep(delay)
+                except requests.exceptions.RequestException as e:
+                    raise ValueError(f"DeepSeek API error: {e}")
+
+    # 流式输出：逐段产出增量文本；只在收到首字节之前重试，已输出的内容不会重复
+    def chat_stream(self, prompt: str, system_prompt: str = "") -> Iterator[str]:
+        headers, data = _build_request(prompt, system_prompt, stream=True)
+        with span('llm', **_request_attrs(data)) as s, self._semaphore:
+            for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+                try:
+                    response = self._session.post(DEEPSEEK_API_URL, headers=headers, json=data, stream=True,
+                                                  timeout=(DEEPSEEK_CONNECT_TIMEOUT, DEEPSEEK_READ_TIMEOUT))
+                    if response.status_code in _RETRY_STATUS and attempt < DEEPSEEK_MAX_RETRIES:
+                        delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                        response.close()
+                        print(f"DeepSeek API returned {response.status_code}, retrying in {delay:.1f}s...")
+                        time.sleep(delay)
+                        continue
+                    response.raise_for_status()
+                    s.set(attempts=attempt + 1)
+                    break
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt >= DEEPSEEK_MAX_RETRIES:
+                        raise ValueError(f"DeepSeek API error: {e}")
+                    delay = _retry_delay(attempt)
+                    print(f"DeepSeek API request failed ({e}), retrying in {delay:.1f}s...")
+                    time.sleep(delay)
+                except requests.exceptions.RequestException as e:
+                    raise ValueError(f"DeepSeek API error: {e}")
+            received = 0
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    received += len(line.encode('utf-8')) + 1
+                    parsed = _parse_stream_line(line)
+                    if parsed is None:
+                        break
+                    delta, usage = parsed
+                    if usage:
+                        _record_response(s, received, usage)
+                    if delta:
+                        if 'ttft_ms' not in s.attrs:
+                            s.set(ttft_ms=s.elapsed() * 1000)
+                        yield delta
+            except requests.exceptions.RequestException as e:
+                raise ValueError(f"DeepSeek API stream error: {e}")
+            finally:
+                s.set(response_bytes=received)
+                response.close()
+
+# asyncio 版本：同一事件循环内的多个调用共享连接池与并发上限
+class AsyncDeepSeekClient:
+    def __init__(self, pool_size: int = DEEPSEEK_POOL_SIZE, max_concurrency: int = DEEPSEEK_MAX_CONCURRENCY):
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(DEEPSEEK_READ_TIMEOUT, connect=DEEPSEEK_CONNECT_TIMEOUT))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def chat(self, prompt: str, system_prompt: str = "") -> str:
+        headers, data = _build_request(prompt, system_prompt)
+        with span('llm', **_request_attrs(data)) as s:
+            async with self._semaphore:
+                for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+                    try:
+                        response = await self._client.post(DEEPSEEK_API_URL, headers=headers, json=data)
+                        if response.status_code in _RETRY_STATUS and attempt < DEEPSEEK_MAX_RETRIES:
+                            delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                            print(f"DeepSeek API returned {response.status_code}, retrying in {delay:.1f}s...")
+                            await asyncio.sleep(delay)
+                            continue
+                        response.raise_for_status()
+                        result = response.json()
+                        s.set(attempts=attempt + 1)
+                        _record_response(s, len(response.content), result.get('usage'))
+                        return result['choices'][0]['message']['content'].strip()
+                    except (httpx.TransportError, httpx.TimeoutException) as e:
+                        if attempt >= DEEPSEEK_MAX_RETRIES:
+                            raise ValueError(f"DeepSeek API error: {e}")
+                        delay = _retry_delay(attempt)
+                        print(f"DeepSeek API request failed ({e}), retrying in {delay:.1f}s...")
+                        await asyncio.sleep(delay)
+                    except httpx.HTTPError as e:
+                        raise ValueError(f"DeepSeek API error: {e}")
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+_client = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()  # 事件循环 -> AsyncDeepSeekClient（httpx 连接绑定在所属循环上）
+
+def get_deepseek_client() -> DeepSeekClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = DeepSeekClient()
+    return _client
+
+def get_async_deepseek_client() -> AsyncDeepSeekClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncDeepSeekClient()
+    return client
+
+# Helper function for DeepSeek API call
+# stream=True 时返回增量文本的迭代器（用于逐字显示报告）
+def call_deepseek_api(prompt: str, system_prompt: str = "", stream: bool = False) -> Union[str, Iterator[str]]:
+    if stream:
+        return get_deepseek_client().chat_stream(prompt, system_prompt)
+    return get_deepseek_client().chat(prompt, system_prompt)
+
+# Async helper for DeepSeek API call（可用 asyncio.gather 并发多个 LLM 调用）
+async def acall_deepseek_api(prompt: str, system_prompt: str = "") -> str:
+    return await get_async_deepseek_client().chat(prompt, system_prompt)
     
-# 文本清洗函数（移除 HTML 标签、规范化空格、多余换行）
+# 文本清洗函数（移除 HTML 标签、规范化空格，保留段落分隔）
+_BLOCK_END = re.compile(r'<br\s*/?>|</(?:p|div|h[1-6]|li|blockquote|tr|section|pre)\s*>', re.I)
+_INVISIBLE_BLOCK = re.compile(r'<(head|script|style)\b[^>]*>.*?</\1\s*>', re.I | re.S)
+
 def clean_text(text: str) -> str:
-    # 移除 HTML/XML 标签
+    # 移除不可见内容（<head>/<script>/<style>），块级标签结尾视为段落分隔
+    text = _INVISIBLE_BLOCK.sub('', text)
+    text = _BLOCK_END.sub('\n\n', text)
+    # 移除 HTML/XML 标签并还原实体
     text = re.sub(r'<[^>]*>', '', text)
-    # 移除多余空格/换行，规范化
-    text = re.sub(r'\s+', ' ', text)  # 多个空格/换行 -> 单空格
-    text = re.sub(r'\n\s*\n', '\n\n', text)  # 保持段落分隔
-    return text.strip()
\ No newline at end of file
+    text = html.unescape(text)
+    # 段落内的空格/换行 -> 单空格；段落之间统一为一个空行
+    paragraphs = (re.sub(r'\s+', ' ', p).strip() for p in _PARAGRAPH_BREAK.split(text))
+    return '\n\n'.join(p for p in paragraphs if p)
\ No newline at end of file
@@ -0,0 +1,242 @@
+# vector_index.py: 可插拔的 FAISS 索引类型（flat / SQ8 / SQ-fp16 / IVF-Flat / IVF-SQ8 / IVF-PQ / HNSW）、按文档分片的并行搜索、内存映射加载与召回率、延迟评估
+import os
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from typing import Dict, Iterable, List, Tuple
+
+# 常量
+INDEX_TYPES = ('flat', 'sq8', 'sq_fp16', 'ivf_flat', 'ivf_sq8', 'ivf_pq', 'hnsw')
+IVF_NLIST = 1024             # IVF 聚类中心数上限（实际取 min(IVF_NLIST, 4*sqrt(N))）
+IVF_TRAIN_PER_LIST = 64      # 训练样本数 = nlist * 该值（上限为全部向量）
+PQ_M = 16                    # PQ 子向量个数上限（需整除维度）
+PQ_NBITS = 8                 # 每个子向量的编码位数
+HNSW_M = 32                  # HNSW 每个节点的邻居数
+HNSW_EF_CONSTRUCTION = 200   # HNSW 构建时的搜索宽度
+NPROBE = 16                  # 查询时 IVF 探查的聚类数
+EF_SEARCH = 64               # 查询时 HNSW 的搜索宽度
+EVAL_QUERIES = 200           # 评估时抽样的查询数
+SQ_TRAIN_SAMPLES = 65536     # 标量量化训练（统计每维取值范围）的抽样数
+INDEX_MMAP = os.name != 'nt' # 以只读内存映射加载索引；Windows 上被映射的文件无法被 os.replace 覆盖，默认关闭
+SHARD_SEARCH_WORKERS = min(8, os.cpu_count() or 1)  # 并行搜索分片的线程数（FAISS 搜索时释放 GIL）
+
+def _nlist_for(n: int) -> int:
+    return max(1, min(IVF_NLIST, int(4 * math.sqrt(n))))
+
+def _pq_m_for(dim: int) -> int:
+    return max(m for m in range(1, PQ_M + 1) if dim % m == 0)
+
+# 训练只用抽样，避免大语料上 k-means 过慢；embeddings 可以是 float16 的内存映射，抽样后再转 float32
+def _training_sample(embeddings: np.ndarray, n_train: int) -> np.ndarray:
+    n = embeddings.shape[0]
+    if n_train < n:
+        embeddings = embeddings[np.sort(np.random.default_rng(0).choice(n, n_train, replace=False))]
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+# 从 IndexIDMap 包装中取出实际的索引对象
+def _base_index(index: faiss.Index) -> faiss.Index:
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+# Function to create a trained, ID-mapped index of the given type (vectors are not added yet)
+def create_index(index_type: str, embeddings: np.ndarray) -> faiss.Index:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}.")
+    n, dim = embeddings.shape
+    nlist = _nlist_for(n)
+    if index_type == 'ivf_pq' and n < max(nlist, 1 << PQ_NBITS):
+        print(f"Only {n} vectors, too few to train IVF-PQ; falling back to ivf_flat.")
+        index_type = 'ivf_flat'
+    if index_type == 'ivf_flat' and n < nlist:
+        print(f"Only {n} vectors, too few to train IVF; falling back to flat.")
+        index_type = 'flat'
+    if index_type == 'ivf_sq8' and n < nlist:
+        print(f"Only {n} vectors, too few to train IVF; falling back to sq8.")
+        index_type = 'sq8'
+
+    if index_type == 'flat':
+        base = faiss.IndexFlatL2(dim)
+    elif index_type == 'hnsw':
+        base = faiss.IndexHNSWFlat(dim, HNSW_M)
+        base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type in ('sq8', 'sq_fp16'):
+        # 每维 1 字节（int8）或 2 字节（fp16）存储，暴力搜索；sq8 需要统计每维取值范围
+        qtype = faiss.ScalarQuantizer.QT_8bit if index_type == 'sq8' else faiss.ScalarQuantizer.QT_fp16
+        base = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        base.train(_training_sample(embeddings, min(n, SQ_TRAIN_SAMPLES)))
+    else:
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == 'ivf_flat':
+            base = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        elif index_type == 'ivf_sq8':
+            base = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+        else:
+            base = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m_for(dim), PQ_NBITS)
+        n_train = min(n, nlist * IVF_TRAIN_PER_LIST)
+        print(f"Training {index_type} (nlist={nlist}) on {n_train} vectors...")
+        base.train(_training_sample(embeddings, n_train))
+    return faiss.IndexIDMap2(base)
+
+# Function to add vectors in batches (embeddings 可以是 float16 的内存映射，逐批转成 float32，内存占用与总量无关)
+def add_vectors(index: faiss.Index, embeddings: np.ndarray, ids: np.ndarray, batch_size: int = 65536) -> None:
+    for start in range(0, embeddings.shape[0], batch_size):
+        batch = np.ascontiguousarray(embeddings[start:start + batch_size], dtype=np.float32)
+        index.add_with_ids(batch, ids[start:start + batch_size])
+
+# Function to recover the stored vectors of an index (用于迁移旧版单一索引)，返回 (vectors, ids)
+# flat 类型无损，SQ/PQ 为解码后的近似值；没有 ID 映射的索引（基线的 IndexFlatL2）中 id 即行号
+def reconstruct_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    wrapper = faiss.downcast_index(index)  # 不覆盖 index：downcast 得到的对象不持有底层索引
+    if isinstance(wrapper, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(wrapper.id_map).astype(np.int64)
+    else:
+        ids = np.arange(index.ntotal, dtype=np.int64)
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        base.make_direct_map()  # IVF 默认不能按 id 取回向量
+    return base.reconstruct_n(0, base.ntotal), ids
+
+# Function to read an index from disk for searching
+# mmap=True 时以只读内存映射加载（IVF 倒排表与 flat/SQ 编码），同一主机上的多个进程共享页缓存而不是各持一份；不支持时退回普通读取
+def read_index_file(path: str, mmap: bool = INDEX_MMAP) -> faiss.Index:
+    index = None
+    if mmap:
+        # 两个标志只能二选一：同时设置时 IVF 类型全部加载失败；新版 faiss 的 IO_FLAG_MMAP_IFC 覆盖全部类型
+        flags = faiss.IO_FLAG_READ_ONLY | getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+        try:
+            index = faiss.read_index(path, flags)
+        except RuntimeError as e:
+            print(f"Memory-mapped load of {path} failed ({e}), reading it into memory instead.")
+    if index is None:
+        index = faiss.read_index(path)
+    configure_search(index)
+    return index
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+def _get_search_pool() -> ThreadPoolExecutor:
+    global _search_pool
+    if _search_pool is None:
+        with _search_pool_lock:
+            if _search_pool is None:
+                _search_pool = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix='hayek-shard')
+    return _search_pool
+
+# 按来源文档分片的索引：每本书一个 ID 映射索引（ID 仍为全局子块位置），可单独重建
+# 提供与 faiss.Index 相同的 search / ntotal；search 的 sources 限定只搜索部分书，多个分片并行搜索后合并 top-k
+class ShardedIndex:
+    def __init__(self, shards: Dict[str, faiss.Index]):
+        self.shards = dict(shards)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(int(shard.ntotal) for shard in self.shards.values())
+
+    @property
+    def sources(self) -> List[str]:
+        return sorted(self.shards)
+
+    def search(self, queries: np.ndarray, k: int, sources: Iterable[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        names = self.sources if not sources else [name for name in dict.fromkeys(sources) if name in self.shards]
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if not names:
+            return np.full((queries.shape[0], k), np.inf, dtype=np.float32), np.full((queries.shape[0], k), -1, dtype=np.int64)
+        if len(names) == 1:
+            return self.shards[names[0]].search(queries, k)
+        results = list(_get_search_pool().map(lambda name: self.shards[name].search(queries, k), names))
+        distances = np.concatenate([d for d, _ in results], axis=1)
+        ids = np.concatenate([i for _, i in results], axis=1)
+        distances = np.where(ids < 0, np.inf, distances)  # 结果不足时的 -1 排到最后
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+# Function to apply query-time parameters (nprobe for IVF, efSearch for HNSW)
+def configure_search(index: faiss.Index, nprobe: int = NPROBE, ef_search: int = EF_SEARCH) -> None:
+    if isinstance(index, ShardedIndex):
+        for shard in index.shards.values():
+            configure_search(shard, nprobe, ef_search)
+        return
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = nprobe
+    elif isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = ef_search
+
+def _index_type_name(index: faiss.Index) -> str:
+    if isinstance(index, ShardedIndex):  # 小分片可能退回了更简单的类型，例如 'flat+ivf_flat'
+        return '+'.join(sorted({_index_type_name(shard) for shard in index.shards.values()}))
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(base, faiss.IndexIVFScalarQuantizer):
+        return 'ivf_sq8'
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return 'sq8' if base.sq.qtype == faiss.ScalarQuantizer.QT_8bit else 'sq_fp16'
+    if isinstance(base, faiss.IndexIVFFlat):
+        return 'ivf_flat'
+    if isinstance(base, faiss.IndexHNSW):
+        return 'hnsw'
+    return 'flat'
+
+# Function to measure recall@k against exact search, per-query latency and serialized size
+# ids[i] 为 embeddings[i] 在索引中的 ID
+def evaluate_index(index: faiss.Index, embeddings: np.ndarray, ids: np.ndarray, k: int, n_queries: int = EVAL_QUERIES) -> dict:
+    n = embeddings.shape[0]
+    k = min(k, n)  # 向量少于 k 时 FAISS 用 -1 填充，ids[-1] 会取到最后一个 ID，使召回率失真
+    rng = np.random.default_rng(0)
+    queries = np.ascontiguousarray(embeddings[rng.choice(n, min(n, n_queries), replace=False)], dtype=np.float32)
+
+    exact = faiss.IndexFlatL2(embeddings.shape[1])
+    exact.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    _, exact_pos = exact.search(queries, k)
+    exact_ids = ids[exact_pos]
+
+    configure_search(index)
+    latencies = []
+    hits = 0
+    for qi in range(queries.shape[0]):
+        t0 = time.perf_counter()
+        _, approx_ids = index.search(queries[qi:qi + 1], k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        hits += len(set(approx_ids[0].tolist()) & set(exact_ids[qi].tolist()))
+
+    return {
+        'index_type': _index_type_name(index),
+        'ntotal': int(index.ntotal),
+        'shards': len(index.shards) if isinstance(index, ShardedIndex) else 1,
+        f'recall@{k}': round(hits / (queries.shape[0] * k), 4),
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'latency_p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'size_bytes': _index_size(index),
+    }
+
+def _index_size(index: faiss.Index) -> int:
+    if isinstance(index, ShardedIndex):
+        return sum(_index_size(shard) for shard in index.shards.values())
+    return int(faiss.serialize_index(index).nbytes)
+
+# Function to build every index type on the same embeddings and evaluate each
+def compare_index_types(embeddings: np.ndarray, ids: np.ndarray, k: int, index_types=INDEX_TYPES) -> List[dict]:
+    reports = []
+    for index_type in index_types:
+        t0 = time.perf_counter()
+        index = create_index(index_type, embeddings)
+        add_vectors(index, embeddings, ids)
+        report = evaluate_index(index, embeddings, ids, k)
+        report['requested_type'] = index_type
+        report['build_seconds'] = round(time.perf_counter() - t0, 2)
+        reports.append(report)
+    return reports
+
+def print_index_report(reports: List[dict]) -> None:
+    recall_key = next(key for key in reports[0] if key.startswith('recall@'))
+    print(f"{'index':<10} {recall_key:>10} {'p50 ms':>9} {'p95 ms':>9} {'size MB':>9}")
+    for r in reports:
+        print(f"{r['index_type']:<10} {r[recall_key]:>10.4f} {r['latency_p50_ms']:>9.3f} "
+              f"{r['latency_p95_ms']:>9.3f} {r['size_bytes'] / 1e6:>9.2f}")